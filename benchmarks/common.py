@@ -0,0 +1,63 @@
+"""
+Synthetic inputs for the benchmarks, so that they can run offline.
+"""
+import numpy as np
+
+import astropy.constants as const
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+
+import sunpy.map
+
+import sunkit_magex.pfss
+
+RSS = 2.5
+# Number of grid points in latitude of the grids to benchmark. Each grid has
+# twice as many points in longitude, and a third as many in radius.
+NS = [45, 90, 180]
+
+
+def _input(br, nr):
+    header = sunkit_magex.pfss.utils.carr_cea_wcs_header(Time('2020-01-01'), br.shape[::-1])
+    return sunkit_magex.pfss.Input(sunpy.map.Map(br, header), nr, RSS)
+
+
+def _grid_coords(ns):
+    s = np.linspace(-1 + 1 / ns, 1 - 1 / ns, ns)
+    nphi = 2 * ns
+    phi = np.linspace(np.pi / nphi, 2 * np.pi - np.pi / nphi, nphi)
+    return s, phi
+
+
+def dipole_input(ns):
+    """
+    Input with a dipole magnetic field at the inner boundary.
+    """
+    s, phi = _grid_coords(ns)
+    br = 2 * s[:, np.newaxis] * np.ones(phi.shape)
+    return _input(br, ns // 3)
+
+
+def harmonic_input(ns, degree=3, order=2):
+    """
+    Input with a single spherical harmonic at the inner boundary, using the
+    analytic solutions in `sunkit_magex.pfss.analytic`.
+    """
+    from sunkit_magex.pfss import analytic
+
+    s, phi = _grid_coords(ns)
+    theta = np.arccos(s)
+    br = analytic.Br(degree, order, RSS)(1, theta[:, np.newaxis] * u.rad, phi * u.rad)
+    return _input(np.asarray(br, dtype=float), ns // 3)
+
+
+def seeds(output, n, r=1.05):
+    """
+    ``n`` field line seeds at radius ``r``, at random (but reproducible)
+    longitudes and latitudes.
+    """
+    rng = np.random.default_rng(0)
+    lon = rng.uniform(0, 360, n) * u.deg
+    lat = rng.uniform(-80, 80, n) * u.deg
+    return SkyCoord(lon, lat, r * np.ones(n) * const.R_sun, frame=output.coordinate_frame)
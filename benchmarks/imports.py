@@ -0,0 +1,22 @@
+"""
+Benchmarks for the time taken to import the package.
+
+These run in a new interpreter, so that nothing has already been imported.
+"""
+
+
+def timeraw_import_pfss():
+    return 'import sunkit_magex.pfss'
+
+
+def timeraw_import_pfss_solver():
+    # Everything needed to solve for the field from a map
+    return '''
+    import sunkit_magex.pfss
+    sunkit_magex.pfss.Input
+    sunkit_magex.pfss.Output
+    '''
+
+
+def timeraw_import_tracing():
+    return 'import sunkit_magex.pfss.tracing'
@@ -0,0 +1,144 @@
+"""
+Benchmarks for reconstructing the magnetic field from a PFSS solution.
+"""
+import numpy as np
+
+import sunkit_magex.pfss
+from sunkit_magex.pfss.grid import Grid
+from sunkit_magex.pfss.interpolator import RegularGridInterpolator
+from .common import NS, RSS, dipole_input, seeds
+
+
+class Output:
+    """
+    Computing the magnetic field on the grid. The results are cached by the
+    output, so a new output is computed before each measurement.
+    """
+    params = NS
+    param_names = ['ns']
+    number = 1
+    repeat = 5
+    timeout = 300
+
+    def setup(self, ns):
+        self.output = sunkit_magex.pfss.pfss(dipole_input(ns))
+
+    def time_common_b(self, ns):
+        self.output._common_b()
+
+    def time_bc(self, ns):
+        self.output.bc
+
+    def time_bg(self, ns):
+        self.output.bg
+
+    def time_brgi(self, ns):
+        self.output._brgi
+
+    def peakmem_bg(self, ns):
+        self.output.bg
+
+
+def random_output(ns, nr=10, nphi=None):
+    """
+    An output with a random vector potential, on a grid with *ns* points in
+    latitude and (by default) ``2 * ns`` points in longitude.
+    """
+    if nphi is None:
+        nphi = 2 * ns
+    rng = np.random.default_rng(0)
+    return sunkit_magex.pfss.Output(rng.random((nphi + 1, ns + 1, nr)),
+                                    rng.random((nphi + 1, ns, nr + 1)),
+                                    rng.random((nphi, ns + 1, nr + 1)),
+                                    Grid(ns, nphi, nr, RSS),
+                                    dipole_input(45).map)
+
+
+class CommonB:
+    """
+    Computing the magnetic field times the face areas on large grids, from a
+    random vector potential (so that solving for it is not needed).
+    """
+    params = [180, 360, 720]
+    param_names = ['ns']
+    timeout = 300
+
+    def setup(self, ns):
+        self.output = random_output(ns)
+
+    def time_calculate_common_b(self, ns):
+        self.output._calculate_common_b()
+
+    def peakmem_calculate_common_b(self, ns):
+        self.output._calculate_common_b()
+
+
+class ComputeBg:
+    """
+    Computing the magnetic field on the grid in blocks of longitudes, using
+    several threads.
+    """
+    params = ([180, 360, 720], [1, 4])
+    param_names = ['ns', 'n_workers']
+    timeout = 300
+
+    def setup(self, ns, n_workers):
+        self.output = random_output(ns)
+
+    def time_compute_bg(self, ns, n_workers):
+        self.output.compute_bg(n_workers=n_workers)
+
+    def peakmem_compute_bg(self, ns, n_workers):
+        self.output.compute_bg(n_workers=n_workers)
+
+
+class ComputeBgBlockSize:
+    """
+    Computing the magnetic field on the grid with different numbers of
+    longitudes in each block, with 720 points in latitude and 100 in radius.
+    The time for each block only depends on the number of points in latitude
+    and radius, so only 128 points in longitude are used to keep the memory
+    needed down.
+    """
+    params = [1, 4, 16, 64, None]
+    param_names = ['phi_block']
+    timeout = 300
+
+    def setup(self, phi_block):
+        self.output = random_output(720, nr=100, nphi=128)
+
+    def time_compute_bg(self, phi_block):
+        self.output.compute_bg(phi_block=phi_block)
+
+    def peakmem_compute_bg(self, phi_block):
+        self.output.compute_bg(phi_block=phi_block)
+
+
+class GetBvec:
+    params = (NS, [100, 10000])
+    param_names = ['ns', 'npoints']
+    timeout = 300
+
+    def setup(self, ns, npoints):
+        self.output = sunkit_magex.pfss.pfss(dipole_input(ns))
+        self.coords = seeds(self.output, npoints)
+        # Build the interpolator outside of the benchmark
+        self.output._brgi
+
+    def time_get_bvec(self, ns, npoints):
+        self.output.get_bvec(self.coords)
+
+
+class Interpolator:
+    params = [100, 10000, 1000000]
+    param_names = ['npoints']
+
+    def setup(self, npoints):
+        shape = (181, 91, 31)
+        points = [np.linspace(0, 1, n) for n in shape]
+        values = np.random.default_rng(0).normal(size=shape + (3,))
+        self.interpolator = RegularGridInterpolator(points, values)
+        self.xi = np.random.default_rng(1).uniform(size=(npoints, 3))
+
+    def time_call(self, npoints):
+        self.interpolator(self.xi)
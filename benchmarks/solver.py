@@ -0,0 +1,42 @@
+"""
+Benchmarks for computing PFSS solutions.
+"""
+import sunkit_magex.pfss
+from .common import NS, dipole_input, harmonic_input
+
+
+class PFSS:
+    params = (NS, ['dense', 'tridiagonal'])
+    param_names = ['ns', 'method']
+    timeout = 300
+
+    def setup(self, ns, method):
+        self.input = dipole_input(ns)
+
+    def time_pfss(self, ns, method):
+        # Include computing the eigenbasis
+        sunkit_magex.pfss.cache.eigenbasis_cache.clear()
+        sunkit_magex.pfss.pfss(self.input, method=method)
+
+    def time_pfss_cached_eigenbasis(self, ns, method):
+        sunkit_magex.pfss.pfss(self.input, method=method)
+
+    def peakmem_pfss(self, ns, method):
+        sunkit_magex.pfss.cache.eigenbasis_cache.clear()
+        sunkit_magex.pfss.pfss(self.input, method=method)
+
+
+class Harmonic:
+    params = NS
+    param_names = ['ns']
+    timeout = 300
+
+    def setup(self, ns):
+        self.input = harmonic_input(ns)
+        sunkit_magex.pfss.cache.eigenbasis_cache.warm(self.input.grid)
+
+    def time_pfss(self, ns):
+        sunkit_magex.pfss.pfss(self.input)
+
+    def time_pfss_surface(self, ns):
+        sunkit_magex.pfss.pfss_surface(self.input)
@@ -0,0 +1,78 @@
+"""
+Benchmarks for tracing field lines, and the properties of the traced field
+lines.
+"""
+import sunkit_magex.pfss
+from sunkit_magex.pfss import tracing
+from .common import dipole_input, seeds
+
+NS = 90
+
+
+class PerformanceTracer:
+    params = [1, 100, 10000]
+    param_names = ['nseeds']
+    timeout = 300
+
+    def setup(self, nseeds):
+        self.output = sunkit_magex.pfss.pfss(dipole_input(NS))
+        self.seeds = seeds(self.output, nseeds)
+        self.tracer = tracing.PerformanceTracer()
+        # Compute the magnetic field outside of the benchmark
+        self.output.bg
+
+    def time_trace(self, nseeds):
+        self.tracer.trace(self.seeds, self.output)
+
+    def peakmem_trace(self, nseeds):
+        self.tracer.trace(self.seeds, self.output)
+
+
+class PythonTracer:
+    params = [1, 10]
+    param_names = ['nseeds']
+    timeout = 300
+
+    def setup(self, nseeds):
+        self.output = sunkit_magex.pfss.pfss(dipole_input(NS))
+        self.seeds = seeds(self.output, nseeds)
+        self.tracer = tracing.PythonTracer()
+        # Build the interpolator outside of the benchmark
+        self.output._brgi
+
+    def time_trace(self, nseeds):
+        self.tracer.trace(self.seeds, self.output)
+
+    def peakmem_trace(self, nseeds):
+        self.tracer.trace(self.seeds, self.output)
+
+
+class FieldLines:
+    """
+    Properties of traced field lines. Some of these are cached, so the field
+    lines are traced again before each measurement.
+    """
+    params = [100, 1000]
+    param_names = ['nseeds']
+    number = 1
+    repeat = 5
+    timeout = 300
+
+    def setup(self, nseeds):
+        output = sunkit_magex.pfss.pfss(dipole_input(NS))
+        self.field_lines = tracing.PerformanceTracer().trace(seeds(output, nseeds), output)
+
+    def time_polarities(self, nseeds):
+        self.field_lines.polarities
+
+    def time_connectivities(self, nseeds):
+        self.field_lines.connectivities
+
+    def time_expansion_factors(self, nseeds):
+        self.field_lines.expansion_factors
+
+    def time_open_field_lines_solar_feet(self, nseeds):
+        self.field_lines.open_field_lines.solar_feet
+
+    def time_open_field_lines_source_surface_feet(self, nseeds):
+        self.field_lines.open_field_lines.source_surface_feet
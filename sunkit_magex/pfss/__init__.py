@@ -1,12 +1,34 @@
-from sunkit_magex.pfss import coords, fieldline, sample_data, tracing, utils
-from sunkit_magex.pfss.input import Input
-from sunkit_magex.pfss.output import Output
-from sunkit_magex.pfss.pfss import pfss
-
-__all__ = ['coords', 'fieldline', 'sample_data', 'tracing', 'utils', 'Input', 'Output', 'pfss']
-
-try:
-    from sunkit_magex.pfss import analytic
-    __all__.append('analytic')
-except ImportError:
-    pass
+import importlib
+import importlib.util
+
+# pfss is imported straight away, since otherwise importing the
+# sunkit_magex.pfss.pfss submodule would replace the pfss function with it
+from sunkit_magex.pfss.pfss import pfss, pfss_batch, pfss_outer_sweep, pfss_rss_sweep, pfss_surface, warmup
+
+# Everything else is imported when it is first used, since some of the
+# submodules import slow to import packages (e.g. sunpy.map, sympy and
+# streamtracer)
+_SUBMODULES = ['accuracy', 'analytic', 'cache', 'coords', 'fieldline', 'instrumentation', 'sample_data', 'tracing', 'utils']
+_ATTRIBUTES = {
+    'Input': 'input',
+    'Output': 'output',
+    'SpectralOutput': 'output',
+}
+
+__all__ = ['cache', 'coords', 'fieldline', 'instrumentation', 'sample_data', 'tracing', 'utils', 'Input', 'Output', 'SpectralOutput', 'pfss', 'pfss_batch', 'pfss_outer_sweep', 'pfss_rss_sweep', 'pfss_surface', 'warmup']
+
+# (these submodules need sympy)
+if importlib.util.find_spec('sympy') is not None:
+    __all__ += ['accuracy', 'analytic']
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'{__name__}.{name}')
+    if name in _ATTRIBUTES:
+        return getattr(importlib.import_module(f'{__name__}.{_ATTRIBUTES[name]}'), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
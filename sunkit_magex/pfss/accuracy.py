@@ -0,0 +1,390 @@
+"""
+Accuracy versus cost of PFSS solutions, measured against analytic solutions.
+
+The functions here solve for the field from a single spherical harmonic
+(see `sunkit_magex.pfss.analytic`) on a range of grids and with a range of
+options, and record the error in the solution alongside the time and memory
+it took to compute. This can be used to choose the cheapest configuration
+that meets a required accuracy.
+
+This can also be run from the command line, e.g.::
+
+    python -m sunkit_magex.pfss.accuracy --nr 10 20 40 --ns 45 90 --nphi 90 180 --tolerance 0.01
+
+Run ``python -m sunkit_magex.pfss.accuracy --help`` for all the options.
+
+Using this module requires ``sympy`` to be installed.
+"""
+import argparse
+import collections
+import itertools
+import time
+import tracemalloc
+
+import numpy as np
+
+import astropy.units as u
+from astropy.time import Time
+
+import sunpy.map
+
+import sunkit_magex.pfss
+from sunkit_magex.pfss import analytic, cache, coords, fieldline, tracing, utils
+from sunkit_magex.pfss.grid import Grid
+
+__all__ = ['INTERPOLATIONS', 'Result', 'evaluate', 'sweep', 'pareto_front', 'cheapest']
+
+INTERPOLATIONS = ('bc', 'bg', 'get_bvec')
+"""
+Ways of sampling the magnetic field that can be compared against the
+analytic solution:
+
+- ``'bc'``: :math:`B_{r}` on the cell faces, from `sunkit_magex.pfss.Output.bc`.
+- ``'bg'``: :math:`B_{r}` averaged to the grid points, from
+  `sunkit_magex.pfss.Output.bg`.
+- ``'get_bvec'``: :math:`B_{r}` interpolated to random points in the
+  domain, using `sunkit_magex.pfss.Output.get_bvec`.
+"""
+
+_FIELDS = ['nr', 'ns', 'nphi', 'step_size', 'interpolation', 'dtype', 'field_error', 'trace_error', 'time',
+           'memory']
+
+
+class Result(collections.namedtuple('Result', _FIELDS)):
+    """
+    Accuracy and cost of one configuration.
+
+    ``dtype`` is the name of the floating point type the output was stored
+    in. ``field_error`` is the largest absolute error in :math:`B_{r}` divided by
+    the largest value of :math:`B_{r}`. ``trace_error`` is the median
+    distance (in solar radii) between the ends of field lines traced through
+    the solution and field lines traced through the analytic field, or NaN if
+    no field lines were traced. ``time`` is the wall time in seconds and
+    ``memory`` the peak memory allocated in bytes, to compute the solution
+    (including the eigenfunctions), sample the field and trace the field
+    lines.
+    """
+    __slots__ = ()
+
+    @property
+    def error(self):
+        """
+        The larger of ``field_error`` and ``trace_error``.
+        """
+        return np.nanmax([self.field_error, self.trace_error])
+
+
+def _input(l, m, rss, nr, ns, nphi):
+    grid = Grid(ns, nphi, nr, rss)
+    theta = np.arccos(grid.sc)[:, np.newaxis] * u.rad
+    br = analytic.Br(l, m, rss)(1, theta, grid.pc * u.rad)
+    # Output.get_bvec assumes the map is centred on 180 degrees longitude
+    header = utils.carr_cea_wcs_header(Time('2020-01-01'), br.shape[::-1],
+                                       map_center_longitude=180 * u.deg)
+    return sunkit_magex.pfss.Input(sunpy.map.Map(np.asarray(br, dtype=float), header), nr, rss)
+
+
+def _sample_br(output, interpolation, l, m, n_points=1000):
+    """
+    Numerical and analytic Br at the sample points for *interpolation*.
+    """
+    grid = output.grid
+    if interpolation == 'bc':
+        r, s, phi = np.exp(grid.rg), grid.sc, grid.pc
+        br = output.bc[0]
+    elif interpolation == 'bg':
+        r, s, phi = np.exp(grid.rg), grid.sg, grid.pg
+        br = output.bg[..., 2]
+    else:
+        rng = np.random.default_rng(0)
+        r = np.exp(rng.uniform(0, np.log(grid.rss), n_points))
+        s = rng.uniform(-0.99, 0.99, n_points)
+        phi = rng.uniform(0, 2 * np.pi, n_points)
+        x, y, z = coords.strum2cart(np.log(r), s, phi)
+        points = fieldline.FieldLine._coords(x, y, z, output)
+        br = output.get_bvec(points)[:, 0]
+        analytic_br = analytic.Br(l, m, grid.rss)(r, np.arccos(s) * u.rad, phi * u.rad)
+        return br.value, np.asarray(analytic_br)
+
+    phi, s, r = np.meshgrid(phi, s, r, indexing='ij')
+    analytic_br = analytic.Br(l, m, grid.rss)(r, np.arccos(s) * u.rad, phi * u.rad)
+    return br.value, np.asarray(analytic_br)
+
+
+def _seeds(n_seeds, rss):
+    """
+    Field line seeds half way between the solar surface and source surface,
+    in (r, theta, phi) coordinates.
+    """
+    rng = np.random.default_rng(1)
+    r = np.full(n_seeds, np.sqrt(rss))
+    theta = np.arccos(rng.uniform(-0.9, 0.9, n_seeds))
+    phi = rng.uniform(0, 2 * np.pi, n_seeds)
+    return r, theta, phi
+
+
+def _analytic_ends(l, m, rss, n_seeds):
+    """
+    Cartesian coordinates of the two ends of field lines traced through the
+    analytic field from each seed, with shape ``(n_seeds, 2, 3)``.
+    """
+    import scipy.integrate
+
+    # The analytic angular components have the opposite sign convention to
+    # the numerical solution
+    funcs = [analytic.Br(l, m, rss), analytic.Btheta(l, m, rss), analytic.Bphi(l, m, rss)]
+    signs = np.array([1, -1, -1])
+
+    def direction(t, y, sign):
+        r, theta, phi = y
+        b = signs * [float(f(r, theta * u.rad, phi * u.rad)) for f in funcs]
+        b = sign * b / np.linalg.norm(b)
+        return [b[0], b[1] / r, b[2] / (r * np.sin(theta))]
+
+    def inner(t, y, sign):
+        return y[0] - 1
+
+    def outer(t, y, sign):
+        return y[0] - rss
+
+    inner.terminal = outer.terminal = True
+
+    ends = []
+    for seed in zip(*_seeds(n_seeds, rss)):
+        seed_ends = []
+        for sign in [1, -1]:
+            sol = scipy.integrate.solve_ivp(direction, (0, 100), seed, events=[inner, outer],
+                                            args=(sign,), rtol=1e-8, atol=1e-10)
+            r, theta, phi = sol.y[:, -1]
+            seed_ends.append(coords.sph2cart(r, theta, phi))
+        ends.append(seed_ends)
+    return np.array(ends)
+
+
+def _trace_error(output, step_size, analytic_ends):
+    """
+    Median distance between the ends of field lines traced through
+    *output* and *analytic_ends*.
+    """
+    r, theta, phi = _seeds(len(analytic_ends), output.grid.rss)
+    x, y, z = coords.sph2cart(r, theta, phi)
+    seeds = fieldline.FieldLine._coords(x, y, z, output)
+    field_lines = tracing.PerformanceTracer(step_size=step_size).trace(seeds, output)
+    errors = []
+    for field_line, ends in zip(field_lines, analytic_ends):
+        if len(field_line) < 2:
+            errors.append(np.inf)
+            continue
+        xyz = np.stack([field_line._x, field_line._y, field_line._z], axis=-1)[[0, -1]]
+        # The field lines can be traced in either direction
+        errors.append(min(np.max(np.linalg.norm(xyz - ends, axis=-1)),
+                          np.max(np.linalg.norm(xyz[::-1] - ends, axis=-1))))
+    return np.median(errors)
+
+
+def evaluate(nr, ns, nphi, interpolation='bc', step_size=None, l=3, m=2, rss=2.5,
+             n_seeds=10, analytic_ends=None, dtype=np.float64):
+    """
+    Measure the accuracy and cost of one configuration.
+
+    Parameters
+    ----------
+    nr, ns, nphi : int
+        Number of grid points.
+    interpolation : str
+        How to sample the magnetic field. One of `INTERPOLATIONS`.
+    step_size : float, optional
+        If given, trace field lines with a
+        `~sunkit_magex.pfss.tracing.PerformanceTracer` with this step size.
+    l, m : int
+        Spherical harmonic numbers of the input.
+    rss : float
+        Source surface radius.
+    n_seeds : int
+        Number of field lines to trace.
+    analytic_ends : numpy.ndarray, optional
+        Ends of the field lines traced through the analytic field. If not
+        given these are computed, which can take a while.
+    dtype : {`numpy.float64`, `numpy.float32`}
+        Floating point type to store the output in.
+
+    Returns
+    -------
+    Result
+
+    Notes
+    -----
+    Before timing, `sunkit_magex.pfss.warmup` is called and the solution is
+    computed once without being timed, so that one-off costs (e.g. compiling
+    functions with numba) are not included. The timed solution is then
+    computed using a new, empty `~sunkit_magex.pfss.cache.EigenbasisCache`,
+    so the time includes computing the eigenfunctions, and the eigenbases
+    cached by the rest of the process are left alone. If `tracemalloc` is already running its peak
+    is not reset, so ``memory`` is an upper bound if the peak before this
+    call was higher than the peak during it.
+    """
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f'interpolation must be one of {INTERPOLATIONS} (got {interpolation!r})')
+    input = _input(l, m, rss, nr, ns, nphi)
+    if step_size is not None and analytic_ends is None:
+        analytic_ends = _analytic_ends(l, m, rss, n_seeds)
+
+    sunkit_magex.pfss.warmup()
+    with cache._use_eigenbasis_cache(cache.EigenbasisCache(maxsize=0)):
+        sunkit_magex.pfss.pfss(input, dtype=dtype)
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    start_memory, previous_peak = tracemalloc.get_traced_memory()
+    if not was_tracing:
+        tracemalloc.reset_peak()
+    # Solve with an empty cache, so that the cost of computing the
+    # eigenfunctions is included, without touching the cache used by the
+    # rest of the process (or by other threads)
+    try:
+        with cache._use_eigenbasis_cache(cache.EigenbasisCache()):
+            start_time = time.perf_counter()
+            output = sunkit_magex.pfss.pfss(input, dtype=dtype)
+            br, analytic_br = _sample_br(output, interpolation, l, m)
+            trace_error = np.nan
+            if step_size is not None:
+                trace_error = _trace_error(output, step_size, analytic_ends)
+            elapsed = time.perf_counter() - start_time
+            # (if tracemalloc was already running its peak isn't reset, so if
+            # this peak was lower than the earlier one this is an upper bound)
+            memory = max(tracemalloc.get_traced_memory()[1], previous_peak) - start_memory
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    field_error = np.max(np.abs(br - analytic_br)) / np.max(np.abs(analytic_br))
+    return Result(nr, ns, nphi, step_size, interpolation, np.dtype(dtype).name, field_error, trace_error,
+                  elapsed, memory)
+
+
+def sweep(nr, ns, nphi, interpolation=('bc',), step_size=(None,), l=3, m=2, rss=2.5, n_seeds=10,
+          dtype=(np.float64,)):
+    """
+    Measure the accuracy and cost of every combination of options.
+
+    Parameters
+    ----------
+    nr, ns, nphi : list of int
+        Numbers of grid points.
+    interpolation : list of str
+        Ways of sampling the magnetic field. See `INTERPOLATIONS`.
+    step_size : list of float or None
+        Tracer step sizes. `None` means that no field lines are traced.
+    l, m, rss, n_seeds :
+        See `evaluate`.
+    dtype : list of numpy.dtype
+        Floating point types to store the output in.
+
+    Returns
+    -------
+    list of Result
+    """
+    analytic_ends = None
+    if any(size is not None for size in step_size):
+        analytic_ends = _analytic_ends(l, m, rss, n_seeds)
+    return [evaluate(*config, l=l, m=m, rss=rss, n_seeds=n_seeds, analytic_ends=analytic_ends,
+                     dtype=config_dtype)
+            for *config, config_dtype in itertools.product(nr, ns, nphi, interpolation, step_size, dtype)]
+
+
+def pareto_front(results, cost='time'):
+    """
+    Configurations that are not beaten in both error and cost by any other
+    configuration.
+
+    Parameters
+    ----------
+    results : list of Result
+    cost : {'time', 'memory'}
+        Which cost to use.
+
+    Returns
+    -------
+    list of Result
+        Sorted by increasing cost.
+    """
+    front = []
+    for result in sorted(results, key=lambda result: (getattr(result, cost), result.error)):
+        if not front or result.error < front[-1].error:
+            front.append(result)
+    return front
+
+
+def cheapest(results, tolerance, cost='time'):
+    """
+    The cheapest configuration with an error no larger than *tolerance*, or
+    `None` if no configuration is accurate enough.
+
+    Parameters
+    ----------
+    results : list of Result
+    tolerance : float
+    cost : {'time', 'memory'}
+        Which cost to use.
+
+    Returns
+    -------
+    Result or None
+    """
+    accurate = [result for result in results if result.error <= tolerance]
+    if not accurate:
+        return None
+    return min(accurate, key=lambda result: getattr(result, cost))
+
+
+def _format(results):
+    lines = [f'{"nr":>5}{"ns":>6}{"nphi":>6}{"step":>7}{"interp":>10}{"dtype":>9}'
+             f'{"field err":>11}{"trace err":>11}{"time (s)":>10}{"mem (MB)":>10}']
+    for r in results:
+        step = '-' if r.step_size is None else f'{r.step_size:g}'
+        lines.append(f'{r.nr:>5}{r.ns:>6}{r.nphi:>6}{step:>7}{r.interpolation:>10}{r.dtype:>9}'
+                     f'{r.field_error:>11.2e}{r.trace_error:>11.2e}{r.time:>10.3f}{r.memory / 1e6:>10.1f}')
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    """
+    Run a sweep from the command line, and print the results.
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m sunkit_magex.pfss.accuracy',
+        description='Measure the accuracy and cost of PFSS solutions against analytic solutions.')
+    parser.add_argument('--nr', type=int, nargs='+', default=[10, 20, 40])
+    parser.add_argument('--ns', type=int, nargs='+', default=[45, 90])
+    parser.add_argument('--nphi', type=int, nargs='+', default=[90, 180])
+    parser.add_argument('--interpolation', nargs='+', choices=INTERPOLATIONS, default=['bc'])
+    parser.add_argument('--step-size', type=float, nargs='+', default=None,
+                        help='tracer step sizes (by default no field lines are traced)')
+    parser.add_argument('--dtype', nargs='+', choices=['float64', 'float32'], default=['float64'],
+                        help='floating point types to store the output in')
+    parser.add_argument('--l', type=int, default=3, help='spherical harmonic degree')
+    parser.add_argument('--m', type=int, default=2, help='spherical harmonic order')
+    parser.add_argument('--rss', type=float, default=2.5)
+    parser.add_argument('--n-seeds', type=int, default=10)
+    parser.add_argument('--cost', choices=['time', 'memory'], default='time')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='print the cheapest configuration with an error below this')
+    args = parser.parse_args(args)
+
+    results = sweep(args.nr, args.ns, args.nphi, interpolation=args.interpolation,
+                    step_size=args.step_size or [None], l=args.l, m=args.m, rss=args.rss,
+                    n_seeds=args.n_seeds, dtype=args.dtype)
+    print('All configurations:')
+    print(_format(results))
+    print(f'\nPareto front (error against {args.cost}):')
+    print(_format(pareto_front(results, args.cost)))
+    if args.tolerance is not None:
+        best = cheapest(results, args.tolerance, args.cost)
+        print(f'\nCheapest configuration with error <= {args.tolerance:g}:')
+        print('None' if best is None else _format([best]))
+    return results
+
+
+if __name__ == '__main__':
+    main()
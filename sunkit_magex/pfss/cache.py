@@ -0,0 +1,492 @@
+"""
+Caching of the eigenfunctions used by the PFSS solver, and of the fields
+derived from PFSS outputs.
+
+The eigenvalues and eigenvectors of the angular part of the PFSS solution
+depend only on the number of grid points in latitude and longitude, and are
+the most expensive part of a solve. They are cached in memory (and optionally
+on disk) so that repeated solves on the same grid, and solves in new
+processes, do not need to recompute them.
+
+Each `sunkit_magex.pfss.Output` also caches the magnetic field and other
+arrays it derives from the vector potential in a `FieldCache`.
+"""
+import collections
+import contextlib
+import os
+import pathlib
+import threading
+
+import numpy as np
+
+from sunkit_magex.pfss import instrumentation
+
+__all__ = ['EigenbasisCache', 'eigenbasis_cache', 'FieldCache']
+
+# Increment this if the discretization changes, to invalidate files on disk
+_CACHE_VERSION = 2
+# Default limit on the memory held by an EigenbasisCache. A dense eigenbasis
+# takes roughly 8 * ns**2 * (nphi / 2 + 1) bytes, so this holds a few
+# ns=360 eigenbases but not one for ns=720.
+_DEFAULT_MAX_BYTES = 2**30
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'nbytes', 'keys',
+                                                 'max_bytes'])
+FieldCacheInfo = collections.namedtuple('FieldCacheInfo', ['hits', 'misses', 'max_bytes', 'nbytes', 'keys'])
+
+
+class EigenbasisCache:
+    r"""
+    Least-recently-used cache of PFSS solver eigenbases.
+
+    Entries are keyed on the ``(ns, nphi)`` shape of a grid and the
+    eigensolver method used to compute them. The eigenvectors
+    for a grid take up :math:`8 n_{s}^{2} (n_{\phi} / 2 + 1)` bytes.
+
+    If only some of the modes are asked for (using the ``m_max`` and
+    ``n_modes`` arguments to `sunkit_magex.pfss.pfss`), only those
+    modes are computed and stored. They are recomputed if more modes are
+    needed later.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of eigenbases to hold in memory. If ``0``, nothing is
+        held in memory.
+    max_bytes : int, optional
+        Maximum total size of the eigenbases held in memory. When a new
+        eigenbasis would take the cache over this size, the least recently
+        used eigenbases are removed from the cache. Eigenbases larger than
+        this are not held in memory at all. If `None`, the size of the cache
+        is only limited by *maxsize*.
+    directory : str, pathlib.Path, optional
+        If given, eigenbases are also saved to ``.npy`` files in this
+        directory, and are loaded from there as memory-mapped arrays
+        when they are not in memory. This allows eigenbases to be shared
+        between processes.
+
+    Notes
+    -----
+    The cache can be used from several threads at once. Each eigenbasis is
+    only computed by one thread at a time, and threads asking for
+    eigenbases of different grids compute them concurrently.
+    """
+    def __init__(self, maxsize=4, directory=None, max_bytes=_DEFAULT_MAX_BYTES):
+        self.maxsize = maxsize
+        self.directory = directory
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.RLock()
+        # Events for the eigenbases currently being computed, keyed like
+        # _entries
+        self._in_flight = {}
+        self.max_bytes = max_bytes
+
+    @property
+    def max_bytes(self):
+        """
+        Maximum total size of the eigenbases held in memory, or `None`.
+        """
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def directory(self):
+        """
+        Directory that eigenbases are stored in on disk, or `None`.
+        """
+        return self._directory
+
+    @directory.setter
+    def directory(self, directory):
+        self._directory = None if directory is None else pathlib.Path(directory)
+
+    @staticmethod
+    def _key(grid, method):
+        return (grid.ns, grid.nphi, method)
+
+    def _path(self, key):
+        return self.directory / 'eigenbasis_v{}_{}_{}_{}.npy'.format(_CACHE_VERSION, *key)
+
+    @staticmethod
+    def _has_modes(arrays, nm, nl):
+        return arrays is not None and arrays[0].shape[0] >= nm and arrays[0].shape[1] >= nl
+
+    def _load(self, key):
+        """
+        Load an eigenbasis saved by `_save`, or return `None` if there isn't
+        a valid one on disk.
+        """
+        if self.directory is None:
+            return None
+        ns = key[0]
+        try:
+            data = np.load(self._path(key), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if data.ndim != 1 or data.dtype != np.float64 or data.size < 2:
+            return None
+        nm, nl = data[:2]
+        if nm != int(nm) or nl != int(nl) or data.size != 2 + int(nm) * int(nl) * (ns + 1):
+            return None
+        nm, nl = int(nm), int(nl)
+        lam = data[2:2 + nm * nl].reshape(nm, nl)
+        Q = data[2 + nm * nl:].reshape(nm, ns, nl)
+        return lam, Q
+
+    def _save(self, key, arrays):
+        """
+        Save an eigenbasis to disk.
+
+        lam and Q are stored together in a single flat array (after the
+        shape of lam), so that they are always replaced together and each
+        can be loaded as a contiguous memory-mapped array.
+        """
+        lam, Q = arrays
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        # Write to a temporary file first so other processes never
+        # see a partially written file
+        tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.concatenate([lam.shape, lam.ravel(), Q.ravel()]).astype(np.float64))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _nbytes(arrays):
+        return sum(arr.nbytes for arr in arrays)
+
+    def _evict(self):
+        # Remove least recently used entries until the cache is within
+        # its limits
+        total = sum(self._nbytes(arrays) for arrays in self._entries.values())
+        while self._entries and (len(self._entries) > self.maxsize or
+                                 (self.max_bytes is not None and total > self.max_bytes)):
+            _, arrays = self._entries.popitem(last=False)
+            total -= self._nbytes(arrays)
+
+    def _store(self, key, arrays):
+        if self.maxsize <= 0:
+            return
+        if self.max_bytes is not None and self._nbytes(arrays) > self.max_bytes:
+            return
+        self._entries[key] = arrays
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def get(self, grid, method='dense', n_workers=1, m_max=None, n_modes=None):
+        """
+        Get the eigenbasis for a grid, computing it if it is not cached.
+
+        Parameters
+        ----------
+        grid : sunkit_magex.pfss.grid.Grid
+        method : {'dense', 'tridiagonal'}
+            Eigensolver method. See `sunkit_magex.pfss.pfss` for details.
+        n_workers : int
+            Number of threads used to compute the eigenbasis if it is not
+            cached.
+        m_max, n_modes : int, optional
+            Only return a subset of the modes. See `sunkit_magex.pfss.pfss`
+            for details.
+
+        Returns
+        -------
+        lam : numpy.ndarray
+            ``(nm, nl)`` shaped array of eigenvalues, where ``nm`` is
+            ``nphi // 2 + 1`` and ``nl`` is ``ns`` if all modes are
+            returned.
+        Q : numpy.ndarray
+            ``(nm, ns, nl)`` shaped array of eigenvectors.
+        """
+        from sunkit_magex.pfss.pfss import _eigenbasis, _truncation
+
+        key = self._key(grid, method)
+        nm, nl = _truncation(grid, m_max, n_modes)
+        while True:
+            with self._lock:
+                arrays = self._entries.get(key)
+                if self._has_modes(arrays, nm, nl):
+                    self._hits += 1
+                    self._entries.move_to_end(key)
+                    lam, Q = arrays
+                    return lam[:nm, :nl], Q[:nm, :, :nl]
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    self._misses += 1
+                    in_flight = self._in_flight[key] = threading.Event()
+                    break
+            # Another thread is computing this eigenbasis, so wait for it
+            # and then look again (it might have computed fewer modes than
+            # are needed here)
+            in_flight.wait()
+
+        # The lock isn't held while loading or computing the eigenbasis, so
+        # eigenbases for other grids can be computed at the same time
+        try:
+            disk_arrays = self._load(key)
+            if self._has_modes(disk_arrays, nm, nl):
+                arrays = disk_arrays
+            else:
+                # Compute enough modes for this request and for the
+                # entry that is being replaced
+                nm_new, nl_new = nm, nl
+                if arrays is not None:
+                    nm_new = max(nm, arrays[0].shape[0])
+                    nl_new = max(nl, arrays[0].shape[1])
+                with instrumentation._stage('eigensolve'):
+                    arrays = _eigenbasis(grid, method, n_workers, m_max=nm_new - 1, n_modes=nl_new)
+                for arr in arrays:
+                    arr.flags.writeable = False
+                if self.directory is not None:
+                    self._save(key, arrays)
+            with self._lock:
+                self._store(key, arrays)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.set()
+
+        lam, Q = arrays
+        return lam[:nm, :nl], Q[:nm, :, :nl]
+
+    def warm(self, *grids, method='dense', n_workers=1):
+        """
+        Compute and cache the eigenbases for one or more grids.
+
+        Parameters
+        ----------
+        grids : sunkit_magex.pfss.grid.Grid
+        method : {'dense', 'tridiagonal'}
+            Eigensolver method. See `sunkit_magex.pfss.pfss` for details.
+        n_workers : int
+            Number of threads used to compute each eigenbasis.
+        """
+        for grid in grids:
+            self.get(grid, method, n_workers)
+
+    def info(self):
+        """
+        Information about the current state of the cache.
+
+        Returns
+        -------
+        CacheInfo
+            A named tuple with fields ``hits``, ``misses``, ``maxsize``,
+            ``currsize``, ``nbytes`` (the total size of the eigenbases
+            held in memory), ``keys`` (the ``(ns, nphi, method)`` entries
+            held in memory, from least to most recently used) and
+            ``max_bytes``.
+        """
+        with self._lock:
+            nbytes = sum(arr.nbytes for arrays in self._entries.values() for arr in arrays)
+            return CacheInfo(self._hits, self._misses, self.maxsize,
+                             len(self._entries), nbytes, list(self._entries), self.max_bytes)
+
+    def clear(self, disk=False):
+        """
+        Remove all eigenbases from the cache.
+
+        Parameters
+        ----------
+        disk : bool
+            If `True`, also delete any eigenbases stored in `directory`.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+            if disk and self.directory is not None:
+                for path in self.directory.glob('eigenbasis_v*.npy'):
+                    path.unlink()
+
+
+eigenbasis_cache = EigenbasisCache()
+"""
+The `EigenbasisCache` used by `sunkit_magex.pfss.pfss`.
+"""
+
+# Caches used instead of eigenbasis_cache in this thread
+_local = threading.local()
+
+
+def _current_eigenbasis_cache():
+    """
+    The `EigenbasisCache` used by solves in this thread.
+    """
+    override = getattr(_local, 'eigenbasis_cache', None)
+    return eigenbasis_cache if override is None else override
+
+
+@contextlib.contextmanager
+def _use_eigenbasis_cache(cache):
+    """
+    Use *cache* instead of `eigenbasis_cache` for solves in this thread.
+    """
+    previous = getattr(_local, 'eigenbasis_cache', None)
+    _local.eigenbasis_cache = cache
+    try:
+        yield cache
+    finally:
+        _local.eigenbasis_cache = previous
+
+
+def _nbytes(value):
+    """
+    Size in bytes of the arrays held by *value*.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(item) for item in value)
+    if hasattr(value, '__dict__'):
+        return sum(_nbytes(item) for item in vars(value).values())
+    return 0
+
+
+class FieldCache:
+    """
+    Least-recently-used cache of the fields derived from a PFSS output.
+
+    Each `sunkit_magex.pfss.Output` has its own cache (in its
+    ``field_cache`` attribute), which holds e.g. the magnetic field on the
+    grid once it has been computed. Access to the cache is thread-safe, and
+    each field is only computed once even if it is asked for from several
+    threads at the same time. A thread computing one field does not block
+    threads getting other fields.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Maximum total size of the arrays held in the cache. When a new field
+        would take the cache over this size, the least recently used fields
+        are removed from the cache. Fields larger than this are computed
+        every time they are asked for. If `None`, the size of the cache is
+        not limited.
+    """
+    def __init__(self, max_bytes=None):
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.RLock()
+        # Events for the fields currently being computed
+        self._in_flight = {}
+        self.max_bytes = max_bytes
+
+    @property
+    def max_bytes(self):
+        """
+        Maximum total size of the arrays held in the cache, or `None`.
+        """
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict(0)
+
+    def _evict(self, nbytes):
+        # Remove least recently used entries until there is room for
+        # nbytes more
+        if self.max_bytes is None:
+            return
+        total = sum(entry_nbytes for _, entry_nbytes in self._entries.values())
+        while self._entries and total + nbytes > self.max_bytes:
+            _, (_, entry_nbytes) = self._entries.popitem(last=False)
+            total -= entry_nbytes
+
+    def get(self, key, compute):
+        """
+        Get a field from the cache, computing it if it is not there.
+
+        Parameters
+        ----------
+        key : hashable
+            Name of the field.
+        compute : callable
+            Called with no arguments to compute the field if it is not in the
+            cache.
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._hits += 1
+                    self._entries.move_to_end(key)
+                    return self._entries[key][0]
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    self._misses += 1
+                    in_flight = self._in_flight[key] = threading.Event()
+                    break
+            # Another thread is computing this field, so wait for it and
+            # then look again (if it was too large to store, or failed to
+            # compute, it is computed here instead)
+            in_flight.wait()
+
+        # The lock isn't held while computing, so other fields can be got
+        # from the cache at the same time
+        try:
+            value = compute()
+            self.set(key, value)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.set()
+        return value
+
+    def set(self, key, value):
+        """
+        Store a field that has already been computed in the cache.
+
+        Parameters
+        ----------
+        key : hashable
+            Name of the field.
+        value :
+            The field.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            nbytes = _nbytes(value)
+            if self.max_bytes is None or nbytes <= self.max_bytes:
+                self._evict(nbytes)
+                self._entries[key] = (value, nbytes)
+
+    def info(self):
+        """
+        Information about the current state of the cache.
+
+        Returns
+        -------
+        FieldCacheInfo
+            A named tuple with fields ``hits``, ``misses``, ``max_bytes``,
+            ``nbytes`` (the total size of the fields held in the cache) and
+            ``keys`` (the fields held in the cache, from least to most
+            recently used).
+        """
+        with self._lock:
+            nbytes = sum(entry_nbytes for _, entry_nbytes in self._entries.values())
+            return FieldCacheInfo(self._hits, self._misses, self.max_bytes, nbytes, list(self._entries))
+
+    def clear(self):
+        """
+        Remove all fields from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def __getstate__(self):
+        # Locks can't be pickled, and the fields can be recomputed
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
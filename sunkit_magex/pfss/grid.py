@@ -1,7 +1,14 @@
+import collections
 import functools
 
 import numpy as np
 
+ResourceEstimate = collections.namedtuple('ResourceEstimate', ['memory', 'flops'])
+ResourceEstimate.__doc__ = """
+Estimated peak memory (in bytes) and number of floating point operations
+used by one stage of a PFSS calculation.
+"""
+
 
 class Grid:
     r"""
@@ -108,3 +115,100 @@ class Grid:
         _, sg, _ = np.meshgrid(self.pg, self.sg, self.rg,
                                indexing='ij')
         return np.sqrt(1 - sg**2)
+
+    def estimate_resources(self, n_seeds=0, method='dense', shell_block=None,
+                           m_max=None, n_modes=None, max_steps='auto', step_size=1, dtype=np.float64):
+        """
+        Estimate the memory and floating point operations needed to compute
+        a PFSS solution on this grid.
+
+        The memory estimates for the ``'pfss'``, ``'bg'`` and ``'brgi'``
+        stages are calibrated against the peak memory measured by
+        `tracemalloc` (see `sunkit_magex.pfss.instrumentation`), and are
+        accurate to within 20% for grids with more than a few tens of
+        thousands of cells. The memory estimate for the ``'trace'`` stage is
+        not calibrated, because streamtracer allocates most of its memory in
+        compiled code where `tracemalloc` cannot see it, so it is only a rough
+        guess. The floating point operation counts are order of
+        magnitude estimates based on the leading terms of each algorithm.
+
+        Parameters
+        ----------
+        n_seeds : int
+            Number of field line seeds to trace.
+        method, shell_block, m_max, n_modes, dtype :
+            Options passed to `sunkit_magex.pfss.pfss`.
+        max_steps, step_size :
+            Options passed to `sunkit_magex.pfss.tracing.PerformanceTracer`.
+
+        Returns
+        -------
+        dict
+            A mapping of stage names to `ResourceEstimate` values. The stages
+            are ``'pfss'`` (`sunkit_magex.pfss.pfss`, assuming the eigenbasis
+            is not already cached), ``'bg'`` (the first access of
+            `sunkit_magex.pfss.Output.bg`), ``'brgi'`` (creating the
+            interpolator used by `sunkit_magex.pfss.Output.get_bvec`) and
+            ``'trace'``
+            (`sunkit_magex.pfss.tracing.PerformanceTracer.trace`). The memory
+            of each stage is the memory allocated during that stage. Results
+            are kept by the output, so the peak memory of a job that runs
+            several stages is at most the sum of their memory.
+        """
+        from sunkit_magex.pfss.output import _default_phi_block
+        from sunkit_magex.pfss.pfss import _EIGH_BLOCK_BYTES, _METHODS, _truncation
+
+        if method not in _METHODS:
+            raise ValueError(f'method must be one of {_METHODS} (got {method!r})')
+
+        ns = self.ns
+        nphi = self.nphi
+        nr = self.nr
+        nm, nl = _truncation(self, m_max, n_modes)
+        itemsize = np.dtype(dtype).itemsize
+        # Number of cells in the vector potential, and grid points in bg
+        ncells = nphi * ns * (nr + 1)
+        npoints = (nphi + 1) * (ns + 1) * (nr + 1)
+        if shell_block is None:
+            shell_block = nr + 1
+        shell_fraction = min(shell_block, nr + 1) / (nr + 1)
+
+        # pfss:
+        # - the eigenbasis, and (for the dense method) a block of matrices
+        #   and their eigenvectors
+        eig_bytes = 8 * nm * ns * nl
+        eig_memory = eig_bytes
+        if method == 'dense':
+            eig_memory += 2 * min(8 * nm * ns**2, _EIGH_BLOCK_BYTES)
+            eig_flops = 9 * nm * ns**3
+        else:
+            eig_flops = 20 * nm * ns * nl
+        # - the vector potential, and psi for a block of shells (and, if the
+        #   vector potential is stored in single precision, the double
+        #   precision vector potential for the block)
+        solve_memory = eig_bytes + 3 * itemsize * ncells + 24 * ncells * shell_fraction
+        if itemsize < 8:
+            solve_memory += 16 * ncells * shell_fraction
+        fft_flops = 2.5 * ncells * np.log2(nphi)
+        solve_flops = (fft_flops / (nr + 1) + 4 * nm * ns * nl +
+                       4 * (nr + 1) * nm * ns * nl + fft_flops + 4 * ncells)
+
+        # bg:
+        # - the output, and the magnetic field on the cell faces (and the
+        #   parts of the vector potential it is computed from) for one block
+        #   of longitudes
+        block_bytes = 8 * (ns + 2) * (nr + 2)
+        phi_block = min(_default_phi_block(self), nphi + 1)
+        bg_memory = 3 * itemsize * npoints + 5 * block_bytes * (phi_block + 1)
+
+        # Tracing
+        if max_steps == 'auto':
+            max_steps = int(4 * nr / step_size)
+        trace_memory = 56 * npoints + 48 * max_steps * n_seeds
+
+        return {
+            'pfss': ResourceEstimate(int(max(eig_memory, solve_memory)), int(eig_flops + solve_flops)),
+            'bg': ResourceEstimate(int(bg_memory), 25 * npoints),
+            'brgi': ResourceEstimate(64 * npoints, 40 * npoints),
+            'trace': ResourceEstimate(int(trace_memory), 800 * max_steps * n_seeds),
+        }
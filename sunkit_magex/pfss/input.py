@@ -3,12 +3,28 @@ import warnings
 
 import numpy as np
 
-import sunpy.map
-
-import sunkit_magex.pfss.utils
 from sunkit_magex.pfss.grid import Grid
 
 
+def _check_br_outer(br, br_outer):
+    """
+    Check that an outer boundary condition map is valid for the inner
+    boundary condition map *br*.
+    """
+    if np.any(~np.isfinite(br_outer.data)):
+        raise ValueError('At least one value in the input is NaN or '
+                         'non-finite. The input must consist solely of '
+                         'finite values.')
+    if br.dimensions != br_outer.dimensions:
+        raise ValueError('br and br_outer must have the same dimensions')
+
+    # (imported here because importing sunpy.map is slow)
+    import sunkit_magex.pfss.utils
+
+    sunkit_magex.pfss.utils.is_cea_map(br_outer, error=True)
+    sunkit_magex.pfss.utils.is_full_sun_synoptic_map(br_outer, error=True)
+
+
 class Input:
     r"""
     Input to PFSS modelling.
@@ -34,6 +50,11 @@ class Input:
     information on the coordinate system.
     """
     def __init__(self, br, nr, rss, br_outer="radial"):
+        # (imported here because importing sunpy.map is slow)
+        import sunpy.map
+
+        import sunkit_magex.pfss.utils
+
         if not isinstance(br, sunpy.map.GenericMap):
             raise ValueError('br must be a sunpy Map')
         if np.any(~np.isfinite(br.data)):
@@ -45,15 +66,7 @@ class Input:
         sunkit_magex.pfss.utils.is_full_sun_synoptic_map(br, error=True)
 
         if isinstance(br_outer, sunpy.map.GenericMap):
-            if np.any(~np.isfinite(br_outer.data)):
-                raise ValueError('At least one value in the input is NaN or '
-                                 'non-finite. The input must consist solely of '
-                                 'finite values.')
-            if br.dimensions != br_outer.dimensions:
-                raise ValueError('br and br_outer must have the same dimensions')
-
-            sunkit_magex.pfss.utils.is_cea_map(br_outer, error=True)
-            sunkit_magex.pfss.utils.is_full_sun_synoptic_map(br_outer, error=True)
+            _check_br_outer(br, br_outer)
         elif isinstance(br_outer, str):
             if br_outer != 'radial':
                 warnings.warn('br_outer will be ignored because it is a string '
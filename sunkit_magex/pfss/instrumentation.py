@@ -0,0 +1,232 @@
+"""
+Opt-in timing and memory instrumentation of PFSS calculations.
+
+Instrumentation is disabled by default. When it is enabled (with `enable` or
+`instrument`), the wall time, CPU time and peak memory allocated by each stage
+of `sunkit_magex.pfss.pfss` are recorded in the ``report`` attribute of the
+returned output. Stages that are computed later by the output (e.g. when
+``Output.bg`` is first accessed) are added to the same report.
+
+`tracemalloc` only records a single peak for the whole process, so the
+peak memory is only recorded for stages run in the thread that enabled
+instrumentation, and includes memory allocated by other threads while the
+stage was running.
+
+Examples
+--------
+>>> import sunkit_magex.pfss.instrumentation as instrumentation
+>>> with instrumentation.instrument():  # doctest: +SKIP
+...     output = sunkit_magex.pfss.pfss(input)
+...     output.bg
+>>> print(output.report)  # doctest: +SKIP
+"""
+import collections
+import contextlib
+import threading
+import time
+import tracemalloc
+
+__all__ = ['StageRecord', 'Report', 'enable', 'disable', 'is_enabled', 'instrument']
+
+StageRecord = collections.namedtuple('StageRecord', ['stage', 'wall_time', 'cpu_time', 'peak_memory'])
+StageRecord.__doc__ = """
+Time and memory used by one stage of a calculation.
+
+``wall_time`` and ``cpu_time`` are in seconds, and ``cpu_time`` includes
+the time used by all threads in the process. ``peak_memory`` is the peak
+memory allocated during the stage above the memory allocated at the start
+of the stage in bytes, or zero if memory is not being traced or the stage
+ran in a different thread to the one that called `enable`.
+"""
+
+_enabled = False
+_hook = None
+_started_tracemalloc = False
+# The thread that memory is recorded for
+_memory_thread = None
+# The report and the stack of running stages for each thread
+_local = threading.local()
+
+
+class Report:
+    """
+    Time and memory used by the stages of a calculation.
+
+    Stages can be nested, e.g. the ``brgi`` stage of `sunkit_magex.pfss.Output`
+    (building the interpolator used for field line tracing) includes the
+    ``bg`` stage if the magnetic field has not been computed already.
+
+    Peak memory is only recorded for stages that ran in the thread that
+    called `enable` (see `StageRecord`).
+
+    Parameters
+    ----------
+    records : list of StageRecord
+    """
+    def __init__(self, records=()):
+        self.records = list(records)
+
+    def totals(self):
+        """
+        Total time and peak memory used by each stage.
+
+        Returns
+        -------
+        dict
+            A mapping from stage name to a `StageRecord` with the times
+            summed over every time the stage ran, and the largest peak memory.
+            Stages are in the order they first ran.
+        """
+        totals = {}
+        for record in self.records:
+            if record.stage in totals:
+                total = totals[record.stage]
+                record = StageRecord(record.stage,
+                                     total.wall_time + record.wall_time,
+                                     total.cpu_time + record.cpu_time,
+                                     max(total.peak_memory, record.peak_memory))
+            totals[record.stage] = record
+        return totals
+
+    def __str__(self):
+        lines = [f'{"stage":<16}{"wall (s)":>12}{"cpu (s)":>12}{"peak (MB)":>12}']
+        for record in self.totals().values():
+            lines.append(f'{record.stage:<16}{record.wall_time:>12.4f}{record.cpu_time:>12.4f}'
+                         f'{record.peak_memory / 1e6:>12.1f}')
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return f'<Report with {len(self.records)} records>'
+
+
+def enable(hook=None, trace_memory=True):
+    """
+    Enable instrumentation.
+
+    Parameters
+    ----------
+    hook : callable, optional
+        If given, called with the `StageRecord` of each stage as soon as it
+        finishes, e.g. to send them to a monitoring system.
+    trace_memory : bool
+        If `True`, start `tracemalloc` (if it is not already running) to
+        record the peak memory of each stage. This slows down memory
+        allocation. Because `tracemalloc` has a single peak for the whole
+        process, peak memory is only recorded for stages run in the thread
+        that calls this function (time is recorded in every thread).
+    """
+    global _enabled, _hook, _started_tracemalloc, _memory_thread
+    _enabled = True
+    _hook = hook
+    _memory_thread = threading.get_ident()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+
+
+def disable():
+    """
+    Disable instrumentation.
+
+    This also stops `tracemalloc` if it was started by `enable`.
+    """
+    global _enabled, _hook, _started_tracemalloc, _memory_thread
+    _enabled = False
+    _hook = None
+    _memory_thread = None
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+
+def is_enabled():
+    """
+    Whether instrumentation is enabled.
+    """
+    return _enabled
+
+
+@contextlib.contextmanager
+def instrument(hook=None, trace_memory=True):
+    """
+    Context manager that enables instrumentation while it is active.
+
+    Parameters
+    ----------
+    hook, trace_memory :
+        See `enable`.
+    """
+    enable(hook, trace_memory)
+    try:
+        yield
+    finally:
+        disable()
+
+
+@contextlib.contextmanager
+def _collect(report):
+    """
+    Add the records of any stages run in this thread to *report*.
+    """
+    previous = getattr(_local, 'report', None)
+    _local.report = report
+    try:
+        yield report
+    finally:
+        _local.report = previous
+
+
+@contextlib.contextmanager
+def _stage(name, report=None):
+    """
+    Record the time and memory used by a stage of a calculation.
+
+    The record is added to *report* if given, or otherwise to the report
+    being collected in this thread.
+    """
+    if not _enabled:
+        yield
+        return
+    if report is not None:
+        with _collect(report), _stage(name):
+            yield
+        return
+
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    # Resetting the peak for a nested stage loses the peak of the enclosing
+    # stage, so keep track of the largest peak of each running stage
+    # before and during its nested stages
+    # (resetting the peak in other threads would lose the peak of the
+    # stages running in this thread)
+    tracing = tracemalloc.is_tracing() and threading.get_ident() == _memory_thread
+    start_memory = 0
+    if tracing:
+        start_memory, peak = tracemalloc.get_traced_memory()
+        if _local.stack:
+            _local.stack[-1][0] = max(_local.stack[-1][0], peak)
+        tracemalloc.reset_peak()
+    nested_peak = [0]
+    _local.stack.append(nested_peak)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        _local.stack.pop()
+
+    peak_memory = 0
+    if tracing and tracemalloc.is_tracing():
+        peak = max(tracemalloc.get_traced_memory()[1], nested_peak[0])
+        peak_memory = max(0, peak - start_memory)
+        if _local.stack:
+            _local.stack[-1][0] = max(_local.stack[-1][0], peak)
+
+    record = StageRecord(name, wall_time, cpu_time, peak_memory)
+    report = getattr(_local, 'report', None)
+    if report is not None:
+        report.records.append(record)
+    if _hook is not None:
+        _hook(record)
@@ -1,4 +1,4 @@
-import functools
+import concurrent.futures
 import warnings
 
 import numpy as np
@@ -9,43 +9,277 @@ from astropy.coordinates import SkyCoord
 import sunpy.map
 
 import sunkit_magex.pfss.coords
+from sunkit_magex.pfss import instrumentation
+from sunkit_magex.pfss.cache import FieldCache
 
 # Default colourmap for magnetic field maps
 _MAG_CMAP = 'RdBu'
-
-
-class Output:
+# Default size of each of the arrays of the magnetic field computed for a
+# single block of longitudes when reconstructing bg
+_BG_BLOCK_BYTES = 2**20
+# Smallest default number of longitudes in each block, so that large grids
+# aren't split into many blocks that are too small to compute efficiently
+_BG_MIN_PHI_BLOCK = 16
+
+
+def _default_phi_block(grid):
+    """
+    Default number of longitudes in each block when reconstructing bg.
+    """
+    return max(_BG_MIN_PHI_BLOCK, _BG_BLOCK_BYTES // (8 * (grid.ns + 2) * (grid.nr + 2)))
+
+
+def _face_factors(grid):
+    """
+    Face normals and area factors (including ghost cells) needed to calculate
+    the magnetic field from the vector potential.
+    """
+    dr = grid.dr
+    ds = grid.ds
+    dp = grid.dp
+
+    nr = grid.nr
+    ns = grid.ns
+
+    rss = grid.rss
+
+    sc = grid.sc
+
+    rg = grid.rg
+    sg = grid.sg
+
+    # Centre of cells in rho (including ghost cells)
+    rc = np.linspace(-0.5 * dr, np.log(rss) + 0.5 * dr, nr + 2)
+    rrc = np.exp(rc)
+
+    # Required face normals:
+    # (the ghost cells at the poles take the values of their neighbours)
+    dnp = np.zeros((ns + 2, 2))
+    dns = np.zeros((ns + 1, 2))
+    dnp[1:-1] = rrc[:2] * np.sqrt(1 - sc[:, np.newaxis]**2) * dp
+    dnp[[0, -1]] = dnp[[1, -2]]
+    dns[1:-1] = rrc[:2] * (np.arcsin(sc[1:]) - np.arcsin(sc[:-1]))[:, np.newaxis]
+    dns[[0, -1]] = dns[[1, -2]]
+    dnr = np.full(ns + 2, rrc[0] * (np.exp(dr) - 1))
+    dnr[[0, -1]] *= -1
+
+    # Required area factors:
+    Sbr = np.zeros((ns + 2, nr + 1))
+    Sbr[1:-1] = np.exp(2 * rg) * ds * dp
+    Sbr[[0, -1]] = Sbr[[1, -2]]
+    # (the radial parts are computed first to keep the order of the
+    # floating point operations the same as in the definitions)
+    Sb_radial = 0.5 * np.exp(2 * rc - dr)
+    Sbs = np.zeros((ns + 1, nr + 2))
+    Sbs[1:-1] = Sb_radial * dp * (np.exp(2 * dr) - 1) * np.sqrt(1 - sg[1:-1, np.newaxis]**2)
+    Sbs[[0, -1]] = Sbs[[1, -2]]
+    Sbp = np.zeros((ns + 2, nr + 2))
+    Sbp[1:-1] = Sb_radial * (np.exp(2 * dr) - 1) * (np.arcsin(sg[1:]) - np.arcsin(sg[:-1]))[:, np.newaxis]
+    Sbp[[0, -1]] = Sbp[[1, -2]]
+    return dnp, dns, dnr, Sbr, Sbs, Sbp
+
+
+def _photosphere(br, bs, bp, factors):
+    """
+    Fill the ghost values of *bs* and *bp* below the photosphere, so that the
+    horizontal current is zero there.
+
+    *bp* can have one less row in phi than *br* and *bs*, in which case the
+    rows of *br* either side of each row of *bp* are used.
+    """
+    dnp, dns, dnr, Sbr, Sbs, Sbp = factors
+    # js = jp = 0 at photosphere:
+    bp[:, :, 0] = Sbp[:, 0] / dnp[:, 0] * (bp[:, :, 1] * dnp[:, 1] / Sbp[:, 1] + br[:-1, :, 0] * dnr / Sbr[:, 0] - br[1:, :, 0] * dnr / Sbr[:, 0])
+    bs[:, :, 0] = Sbs[:, 0] / dns[:, 0] * (bs[:, :, 1] * dns[:, 1] / Sbs[:, 1] + br[:, :-1, 0] * dnr[:-1] / Sbr[:-1, 0] - br[:, 1:, 0] * dnr[1:] / Sbr[1:, 0])
+
+
+def _average_to_grid(br, bs, bp, Sbr, Sbs, Sbp, out):
+    """
+    Average the magnetic field times face areas to the grid points, writing
+    the ``(bphi, bs, brho)`` components to the last axis of *out*.
+    """
+    bpg, bsg, brg = out[..., 0], out[..., 1], out[..., 2]
+    # Weighted average to grid points:
+    # (computed in place in the output array)
+    np.add(br[:-1, :-1, :], br[1:, :-1, :], out=brg)
+    brg += br[1:, 1:, :]
+    brg += br[:-1, 1:, :]
+    brg /= 2 * (Sbr[:-1, :] + Sbr[1:, :])
+    np.add(bs[:-1, :, :-1], bs[1:, :, :-1], out=bsg)
+    bsg += bs[1:, :, 1:]
+    bsg += bs[:-1, :, 1:]
+    bsg /= 2 * (Sbs[:, :-1] + Sbs[:, 1:])
+    np.add(bp[:, :-1, :-1], bp[:, 1:, :-1], out=bpg)
+    bpg += bp[:, 1:, 1:]
+    bpg += bp[:, :-1, 1:]
+    bpg /= (Sbp[:-1, :-1] + Sbp[1:, :-1] +
+            Sbp[1:, 1:] + Sbp[:-1, 1:])
+    bsg *= -1
+    return out
+
+
+def _prepolar_b(al, p0, p1, factors):
+    """
+    Magnetic field times face areas for the rows ``p0 <= P < p1`` (including
+    the ghost rows at ``P = 0`` and ``P = nphi + 1``) of the arrays computed by
+    `Output._calculate_common_b`, with all the ghost values filled apart from
+    those at the poles (which are left as zero).
+
+    *bp* is only returned for the rows ``p0 <= P < p1 - 1``.
+    """
+    alr, als, alp = al
+    nphi, ns, nr = alp.shape[0], als.shape[1], als.shape[2] - 1
+    P = np.arange(p0, p1)
+    # Columns of the vector potential used by each row (wrapping the ghost
+    # rows around so the field is periodic in phi)
+    cols = np.where(P == 0, nphi, np.where(P == nphi + 1, 1, P))
+
+    br = np.zeros((p1 - p0, ns + 2, nr + 1))
+    bs = np.zeros((p1 - p0, ns + 1, nr + 2))
+    bp = np.zeros((p1 - p0 - 1, ns + 2, nr + 2))
+    # (computed in the same order as Output._calculate_common_b so the
+    # results are identical, and in double precision even if the vector
+    # potential is stored in single precision)
+    alp_c = alp[cols - 1]
+    br_inner = br[:, 1:-1, :]
+    np.subtract(als[cols], als[cols - 1], out=br_inner, dtype=np.float64)
+    br_inner += alp_c[:, :-1, :]
+    br_inner -= alp_c[:, 1:, :]
+    np.subtract(alp_c[:, :, 1:], alp_c[:, :, :-1], out=bs[:, :, 1:-1], dtype=np.float64)
+    del alp_c
+    np.subtract(als[p0:p1 - 1, :, :-1], als[p0:p1 - 1, :, 1:], out=bp[:, 1:-1, 1:-1],
+                dtype=np.float64)
+
+    # - zero-gradient at outer boundary:
+    bs[:, :, -1] = 2 * bs[:, :, -2] - bs[:, :, -3]
+    bp[:, 1:-1, -1] = 2 * bp[:, 1:-1, -2] - bp[:, 1:-1, -3]
+    _photosphere(br, bs, bp, factors)
+    return br, bs, bp
+
+
+def _common_b_blocks(grid, al, dtype):
+    """
+    The arrays computed by `Output._calculate_common_b`, stored as *dtype*.
+
+    The magnetic field is computed in double precision for blocks of
+    longitudes at a time, and only rounded to *dtype* when it is stored.
+    """
+    nr, ns, nphi = grid.nr, grid.ns, grid.nphi
+    phi_block = _default_phi_block(grid)
+    factors = _face_factors(grid)
+    br = np.zeros((nphi + 2, ns + 2, nr + 1), dtype=dtype)
+    bs = np.zeros((nphi + 2, ns + 1, nr + 2), dtype=dtype)
+    bp = np.zeros((nphi + 1, ns + 2, nr + 2), dtype=dtype)
+    # The values of bs next to each pole, which are needed to fill its
+    # ghost values at the poles
+    bs_rows = np.empty((nphi + 2, 2, nr + 2))
+    for i0 in range(0, nphi + 1, phi_block):
+        i1 = min(i0 + phi_block, nphi + 1)
+        br_block, bs_block, bp_block = _prepolar_b(al, i0, i1 + 1, factors)
+        # (the last row of br and bs overlaps with the next block)
+        br[i0:i1 + 1] = br_block
+        bs[i0:i1 + 1] = bs_block
+        bp[i0:i1] = bp_block
+        bs_rows[i0:i1 + 1] = bs_block[:, [1, ns - 1], :]
+
+    # - polar boundaries, as in Output._calculate_common_b
+    i1 = (np.arange(nphi + 2) + nphi // 2) % nphi
+    br[:, -1, :] = br[i1, -2, :]
+    br[:, 0, :] = br[i1, 1, :]
+    bs[:, -1, :] = 0.5 * (bs_rows[:, 1] - bs_rows[i1, 1])
+    bs[:, 0, :] = 0.5 * (bs_rows[:, 0] - bs_rows[i1, 0])
+    bp[:, -1, :] = -bp[i1[:-1], -2, :]
+    bp[:, 0, :] = -bp[i1[:-1], 1, :]
+    return br, bs, bp, *factors[3:]
+
+
+def _bg_blocks(grid, al, n_workers=1, phi_block=None, out=None):
+    """
+    Average the magnetic field to the grid points, for blocks of *phi_block*
+    longitudes at a time using up to *n_workers* threads.
+
+    The magnetic field on the cell faces is only ever computed for one block
+    at a time, so apart from *out* the memory used is proportional to the
+    size of each block rather than the whole volume. Each block is computed
+    in double precision, and only rounded to the dtype of *out* when it is
+    stored.
+    """
+    nr, ns, nphi = grid.nr, grid.ns, grid.nphi
+    shape = (nphi + 1, ns + 1, nr + 1, 3)
+    if n_workers < 1:
+        raise ValueError(f'n_workers must be at least 1 (got {n_workers})')
+    if phi_block is None:
+        phi_block = _default_phi_block(grid)
+    if phi_block < 1:
+        raise ValueError(f'phi_block must be at least 1 (got {phi_block})')
+    if out is None:
+        out = np.empty(shape, dtype=al[1].dtype)
+    elif out.shape != shape:
+        raise ValueError(f'out must have shape {shape} (got {out.shape})')
+
+    factors = _face_factors(grid)
+    Sbr, Sbs, Sbp = factors[3:]
+    # The values next to each pole, over all longitudes, which are needed to
+    # fill the ghost values at the poles once every block has been computed
+    br_rows = np.empty((nphi + 2, 2, nr + 1))
+    bs_rows = np.empty((nphi + 2, 2, nr + 2))
+    bp_rows = np.empty((nphi + 1, 2, nr + 2))
+
+    def compute_block(i0):
+        i1 = min(i0 + phi_block, nphi + 1)
+        br, bs, bp = _prepolar_b(al, i0, i1 + 1, factors)
+        if out.dtype == np.float64:
+            _average_to_grid(br, bs, bp, Sbr, Sbs, Sbp, out[i0:i1])
+        else:
+            out[i0:i1] = _average_to_grid(br, bs, bp, Sbr, Sbs, Sbp, np.empty(out[i0:i1].shape))
+        # (the last row of br and bs overlaps with the next block)
+        n = i1 - i0 + (i1 == nphi + 1)
+        br_rows[i0:i0 + n] = br[:n, [1, ns], :]
+        bs_rows[i0:i0 + n] = bs[:n, [1, ns - 1], :]
+        bp_rows[i0:i1] = bp[:, [1, ns], :]
+
+    starts = range(0, nphi + 1, phi_block)
+    if n_workers == 1 or len(starts) == 1:
+        for i0 in starts:
+            compute_block(i0)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(min(n_workers, len(starts))) as executor:
+            # Consume the results so that any exceptions are raised here
+            list(executor.map(compute_block, starts))
+
+    # - polar boundaries as in dumfric:
+    #   (the ghost cells at each pole take the values on the opposite
+    #   side of the pole)
+    i1 = (np.arange(nphi + 2) + nphi // 2) % nphi
+    for pole, rows, s, flip in ((0, slice(0, 2), slice(0, 1), False),
+                                (1, slice(ns, ns + 2), slice(ns, ns + 1), True)):
+        br = np.stack([br_rows[i1, pole], br_rows[:, pole]], axis=1)
+        bs = 0.5 * (bs_rows[:, pole] - bs_rows[i1, pole])[:, np.newaxis]
+        bp = np.stack([-bp_rows[i1[:-1], pole], bp_rows[:, pole]], axis=1)
+        if flip:
+            br = br[:, ::-1]
+            bp = bp[:, ::-1]
+        out[:, s] = _average_to_grid(br, bs, bp, Sbr[rows], Sbs[s], Sbp[rows],
+                                     np.empty(out[:, s].shape))
+    return out
+
+
+class _BaseOutput:
     '''
-    Output of PFSS modelling.
-
-    Parameters
-    ----------
-    alr :
-        Vector potential * grid spacing in radial direction.
-    als :
-        Vector potential * grid spacing in elevation direction.
-    alp :
-        Vector potential * grid spacing in azimuth direction.
-    grid : Grid
-        Grid that the output was calculated on.
-    input_map : sunpy.map.GenericMap
-        The input map.
-
-    Notes
-    -----
-    Instances of this class are intended to be created by `sunkit_magex.pfss.pfss`, and
-    not by users.
+    Properties shared by the different types of PFSS output.
     '''
-    def __init__(self, alr, als, alp, grid, input_map=None):
-        self._alr = alr
-        self._als = als
-        self._alp = alp
+    def __init__(self, grid, input_map=None, m_max=None, n_modes=None):
         self.grid = grid
         self.input_map = input_map
-
-        # Cache attributes
-        self._common_b_cache = None
-        self._rgi = None
+        self.m_max = grid.nphi // 2 if m_max is None else m_max
+        """Largest azimuthal mode number included in the solution."""
+        self.n_modes = grid.ns if n_modes is None else n_modes
+        """Number of latitudinal eigenmodes included for each azimuthal mode."""
+        self.report = instrumentation.Report()
+        """
+        `~sunkit_magex.pfss.instrumentation.Report` of the time and memory
+        used to calculate this output, if instrumentation is enabled.
+        """
 
     def _wcs_header(self):
         """
@@ -88,6 +322,76 @@ class Output:
         unit = self.input_map.unit
         return u.dimensionless_unscaled if unit is None else unit
 
+    def _br_map(self, br):
+        """
+        Create a map from a ``(nphi, ns)`` array of radial magnetic field.
+        """
+        m = sunpy.map.Map((br.T, self._wcs_header()))
+        if 'bunit' in self.input_map.meta:
+            m.meta['bunit'] = self.input_map.meta['bunit']
+        vlim = np.max(np.abs(br))
+        m.plot_settings['cmap'] = _MAG_CMAP
+        m.plot_settings['vmin'] = -vlim
+        m.plot_settings['vmax'] = vlim
+        return m
+
+
+class Output(_BaseOutput):
+    '''
+    Output of PFSS modelling.
+
+    Parameters
+    ----------
+    alr :
+        Vector potential * grid spacing in radial direction.
+    als :
+        Vector potential * grid spacing in elevation direction.
+    alp :
+        Vector potential * grid spacing in azimuth direction.
+    grid : Grid
+        Grid that the output was calculated on.
+    input_map : sunpy.map.GenericMap
+        The input map.
+    m_max, n_modes : int, optional
+        The largest azimuthal mode number and the number of latitudinal
+        eigenmodes included in the solution. Defaults to all of the modes on
+        the grid.
+
+    Notes
+    -----
+    Instances of this class are intended to be created by `sunkit_magex.pfss.pfss`, and
+    not by users.
+    '''
+    def __init__(self, alr, als, alp, grid, input_map=None, m_max=None, n_modes=None):
+        super().__init__(grid, input_map, m_max, n_modes)
+        self._alr = alr
+        self._als = als
+        self._alp = alp
+
+        self.field_cache = FieldCache()
+        """
+        `~sunkit_magex.pfss.cache.FieldCache` of the fields derived from the
+        vector potential. Set ``field_cache.max_bytes`` to limit the memory
+        it uses.
+        """
+
+    def clear_cache(self):
+        """
+        Remove all the fields derived from the vector potential (e.g. `bg`)
+        from `field_cache`, to free the memory they use.
+
+        They are recomputed if they are needed again.
+        """
+        self.field_cache.clear()
+
+    @property
+    def dtype(self):
+        """
+        Floating point type that the vector potential, and the magnetic field
+        arrays derived from it, are stored in.
+        """
+        return self._als.dtype
+
     @property
     def source_surface_br(self):
         """
@@ -100,14 +404,7 @@ class Output:
         # Get radial component at the top
         br = self.bc[0][:, :, -1].to_value(self.bunit)
         # Remove extra ghost cells off the edge of the grid
-        m = sunpy.map.Map((br.T, self._wcs_header()))
-        if 'bunit' in self.input_map.meta:
-            m.meta['bunit'] = self.input_map.meta['bunit']
-        vlim = np.max(np.abs(br))
-        m.plot_settings['cmap'] = _MAG_CMAP
-        m.plot_settings['vmin'] = -vlim
-        m.plot_settings['vmax'] = vlim
-        return m
+        return self._br_map(br)
 
     @property
     def source_surface_pils(self):
@@ -130,44 +427,45 @@ class Output:
         """
         Regular grid interpolator for B.
         """
+        return self.field_cache.get('brgi', self._calculate_brgi)
+
+    def _calculate_brgi(self):
         from sunkit_magex.pfss.interpolator import RegularGridInterpolator as rgi
-        if self._rgi is not None:
-            return self._rgi
-
-        f32 = np.float32
-        # - (rho,s,phi) coordinates:
-        rho = self.grid.rg.astype(f32)
-        s = self.grid.sg.astype(f32)
-        phi = self.grid.pg.astype(f32)
-        br, bth, bph = self.bg[..., 2], self.bg[..., 1], self.bg[..., 0]
-
-        # Because we need the cartesian grid to stretch just beyond r=rss,
-        # add an extra dummy layer of magnetic field pointing radially outwards
-        rho = np.append(rho, rho[-1] + 0.01)
-        extras = np.ones(br.shape[0:2] + (1, )) * self.bunit
-        br = np.concatenate((br, extras), axis=2).astype(f32)
-        bth = np.concatenate((bth, 0 * extras), axis=2).astype(f32)
-        bph = np.concatenate((bph, 0 * extras), axis=2).astype(f32)
-
-        # - convert to Cartesian components and make interpolator on
-        # (rho,s,phi) grid:
-        ph3, s3, rh3 = np.meshgrid(phi, s, rho, indexing='ij')
-        sin_th = np.sqrt(1 - s3**2)
-        cos_th = s3
-        sin_ph = np.sin(ph3)
-        cos_ph = np.cos(ph3)
-
-        # Directly stack the expressions below, to save a bit of memory
-        # bx = (sin_th * cos_ph * br) + (cos_th * cos_ph * bth) - (sin_ph * bph)
-        # by = (sin_th * sin_ph * br) + (cos_th * sin_ph * bth) + (cos_ph * bph)
-        # bz = (cos_th * br) - (sin_th * bth)
-        bstack = np.stack(((sin_th * cos_ph * br) + (cos_th * cos_ph * bth) - (sin_ph * bph),
-                           (sin_th * sin_ph * br) + (cos_th * sin_ph * bth) + (cos_ph * bph),
-                           (cos_th * br) - (sin_th * bth)),
-                          axis=-1)
-
-        self._rgi = rgi((phi, s, rho), bstack)
-        return self._rgi
+
+        with instrumentation._stage('brgi', self.report):
+            f32 = np.float32
+            # - (rho,s,phi) coordinates:
+            rho = self.grid.rg.astype(f32)
+            s = self.grid.sg.astype(f32)
+            phi = self.grid.pg.astype(f32)
+            bg = self.bg_value
+            br, bth, bph = bg[..., 2], bg[..., 1], bg[..., 0]
+
+            # Because we need the cartesian grid to stretch just beyond r=rss,
+            # add an extra dummy layer of magnetic field pointing radially outwards
+            rho = np.append(rho, rho[-1] + 0.01)
+            extras = np.ones(br.shape[0:2] + (1, ))
+            br = np.concatenate((br, extras), axis=2).astype(f32)
+            bth = np.concatenate((bth, 0 * extras), axis=2).astype(f32)
+            bph = np.concatenate((bph, 0 * extras), axis=2).astype(f32)
+
+            # - convert to Cartesian components and make interpolator on
+            # (rho,s,phi) grid:
+            ph3, s3, rh3 = np.meshgrid(phi, s, rho, indexing='ij')
+            sin_th = np.sqrt(1 - s3**2)
+            cos_th = s3
+            sin_ph = np.sin(ph3)
+            cos_ph = np.cos(ph3)
+
+            # Directly stack the expressions below, to save a bit of memory
+            # bx = (sin_th * cos_ph * br) + (cos_th * cos_ph * bth) - (sin_ph * bph)
+            # by = (sin_th * sin_ph * br) + (cos_th * sin_ph * bth) + (cos_ph * bph)
+            # bz = (cos_th * br) - (sin_th * bth)
+            bstack = np.stack(((sin_th * cos_ph * br) + (cos_th * cos_ph * bth) - (sin_ph * bph),
+                               (sin_th * sin_ph * br) + (cos_th * sin_ph * bth) + (cos_ph * bph),
+                               (cos_th * br) - (sin_th * bth)),
+                              axis=-1)
+            return rgi((phi, s, rho), bstack)
 
     def _bTrace(self, t, coord, direction):
         """
@@ -254,24 +552,40 @@ class Output:
         the ``r`` component is located on the cell faces at constant ``r``
         values.
         """
+        return tuple(b << self.bunit for b in self.bc_value)
+
+    @property
+    def bc_value(self):
+        """
+        B on the centres of the cell faces, without units.
+
+        This is the same as `bc`, but returns `numpy.ndarray` in units of
+        `bunit`, which avoids the overhead of `~astropy.units.Quantity`.
+
+        Returns
+        -------
+        br, btheta, bphi : numpy.ndarray
+            Read-only arrays.
+        """
+        return self.field_cache.get('bc', self._calculate_bc)
+
+    def _calculate_bc(self):
         br, bs, bp, Sbr, Sbs, Sbp = self._common_b()
-        # Remove area factors:
-        br = br.copy()
-        bs = bs.copy()
-        bp = bp.copy()
-        for i in range(self.grid.nphi + 2):
-            br[i, :, :] = br[i, :, :] / Sbr
-            bs[i, :, :] = bs[i, :, :] / Sbs
-        for i in range(self.grid.nphi + 1):
-            bp[i, :, :] = bp[i, :, :] / Sbp
-
-        # Slice to remove ghost cells
-        return (br[1:-1, 1:-1, :] * self.bunit,
-                -bs[1:-1, :, 1:-1] * self.bunit,
-                bp[:, 1:-1, 1:-1] * self.bunit)
+        # Remove area factors, slicing to remove ghost cells:
+        # (in double precision, only rounding to dtype when storing)
+        br = self._divide(br[1:-1, 1:-1, :], Sbr[1:-1, :])
+        bs = self._divide(bs[1:-1, :, 1:-1], Sbs[:, 1:-1])
+        np.negative(bs, out=bs)
+        bp = self._divide(bp[:, 1:-1, 1:-1], Sbp[1:-1, 1:-1])
+        for b in (br, bs, bp):
+            b.flags.writeable = False
+        return br, bs, bp
+
+    def _divide(self, a, b):
+        out = np.empty(np.broadcast_shapes(a.shape, b.shape), dtype=self.dtype)
+        return np.divide(a, b, out=out, dtype=np.float64)
 
     @property
-    @functools.lru_cache(maxsize=1)
     def bg(self):
         """
         B as a (weighted) averaged on grid points.
@@ -283,105 +597,109 @@ class Output:
             The last index gives the corodinate axis, 0 for Bphi, 1 for Bs, 2
             for Brho. Because the phi dimension is periodic,
             ``bg[0, :, :] == bg[-1, :, :]``.
+            This is a read-only view of `bg_value`.
         """
-        br, bs, bp, Sbr, Sbs, Sbp = self._common_b()
-        # Weighted average to grid points:
-        brg = br[:-1, :-1, :] + br[1:, :-1, :] + br[1:, 1:, :] + br[:-1, 1:, :]
-        bsg = bs[:-1, :, :-1] + bs[1:, :, :-1] + bs[1:, :, 1:] + bs[:-1, :, 1:]
-        bpg = bp[:, :-1, :-1] + bp[:, 1:, :-1] + bp[:, 1:, 1:] + bp[:, :-1, 1:]
-        for i in range(self.grid.nphi + 1):
-            brg[i, :, :] /= 2 * (Sbr[:-1, :] + Sbr[1:, :])
-            bsg[i, :, :] /= 2 * (Sbs[:, :-1] + Sbs[:, 1:])
-        for i in range(self.grid.nphi + 1):
-            bpg[i, :, :] /= (Sbp[:-1, :-1] + Sbp[1:, :-1] +
-                             Sbp[1:, 1:] + Sbp[:-1, 1:])
-        bsg *= -1
-        out = np.stack((bpg, bsg, brg), axis=-1)
+        return self.bg_value << self.bunit
+
+    @property
+    def bg_value(self):
+        """
+        B as a (weighted) averaged on grid points, without units.
+
+        This is the same as `bg`, but returns a `numpy.ndarray` in units of
+        `bunit`, which avoids the overhead of `~astropy.units.Quantity`.
+
+        Returns
+        -------
+        numpy.ndarray
+            A read-only ``(nphi + 1, ns + 1, nrho + 1, 3)`` shaped array.
+        """
+        return self.field_cache.get('bg', self._calculate_bg)
+
+    def _calculate_bg(self):
+        with instrumentation._stage('bg', self.report):
+            out = _bg_blocks(self.grid, self._al)
         out.flags.writeable = False
-        return out * self.bunit
+        return out
+
+    def compute_bg(self, n_workers=1, phi_block=None, out=None):
+        """
+        Compute `bg_value` for blocks of longitudes in parallel.
+
+        Apart from the returned array, the memory used is proportional to
+        the size of each block rather than the whole grid. The result is
+        stored in `field_cache`, so later calls to `bg` and `bg_value`
+        return it without recomputing it.
+
+        Parameters
+        ----------
+        n_workers : int
+            Number of threads used to compute the blocks.
+        phi_block : int, optional
+            Number of grid points in longitude computed in each block. By
+            default each block is 1 MB per field component, or 16 longitudes
+            if that is larger.
+        out : numpy.ndarray, optional
+            A ``(nphi + 1, ns + 1, nrho + 1, 3)`` shaped array of `dtype` to
+            write the result to, e.g. a memory-mapped array created with
+            `numpy.lib.format.open_memmap` for grids too large to hold in
+            memory. By default a new array is created.
+
+        Returns
+        -------
+        numpy.ndarray
+            A read-only view of the magnetic field on the grid points, the
+            same as `bg_value`.
+        """
+        if out is not None and out.dtype != self.dtype:
+            raise ValueError(f'out must have dtype {self.dtype} (got {out.dtype})')
+        with instrumentation._stage('bg', self.report):
+            bg = _bg_blocks(self.grid, self._al, n_workers=n_workers,
+                            phi_block=phi_block, out=out).view()
+        bg.flags.writeable = False
+        self.field_cache.set('bg', bg)
+        return bg
 
     @property
-    @functools.lru_cache(maxsize=1)
     def _modbg(self):
-        return np.linalg.norm(self.bg, axis=-1)
+        return self.field_cache.get('modbg', lambda: np.linalg.norm(self.bg_value, axis=-1))
 
     def _common_b(self):
         """
         Common code needed to calculate magnetic field from vector potential.
         """
-        if self._common_b_cache is not None:
-            return self._common_b_cache
+        def compute():
+            with instrumentation._stage('common_b', self.report):
+                return self._calculate_common_b()
 
-        dr = self.grid.dr
-        ds = self.grid.ds
-        dp = self.grid.dp
+        return self.field_cache.get('common_b', compute)
+
+    def _calculate_common_b(self):
+        """
+        Calculate the magnetic field times face areas, and the face areas.
+        """
+        if self.dtype != np.float64:
+            return _common_b_blocks(self.grid, self._al, self.dtype)
 
         nr = self.grid.nr
         ns = self.grid.ns
         nphi = self.grid.nphi
 
-        rss = self.grid.rss
-
-        rc = self.grid.rc
-        sc = self.grid.sc
-
-        rg = self.grid.rg
-        sg = self.grid.sg
-
         alr, als, alp = self._al
-
-        # Centre of cells in rho (including ghost cells)
-        rc = np.linspace(-0.5 * dr, np.log(rss) + 0.5 * dr, nr + 2)
-        rrc = np.exp(rc)
-        thc = np.zeros(ns + 2) - 1
-        thc[1:-1] = np.arccos(sc)
-        # Centre of cells in phi (including ghost cells)
-        np.linspace(-0.5 * dp, 2 * np.pi + 0.5 * dp, nphi + 2)
-
-        # Required face normals:
-        dnp = np.zeros((ns + 2, 2))
-        dns = np.zeros((ns + 1, 2))
-        dnr = np.zeros(ns + 2)
-        for k in range(2):
-            for j in range(1, ns + 1):
-                dnp[j, k] = rrc[k] * np.sqrt(1 - sc[j - 1]**2) * dp
-            dnp[0, k] = dnp[1, k]
-            dnp[-1, k] = dnp[-2, k]
-            for j in range(1, ns):
-                dns[j, k] = rrc[k] * (np.arcsin(sc[j]) - np.arcsin(sc[j - 1]))
-            dns[0, k] = dns[1, k]
-            dns[-1, k] = dns[-2, k]
-        for j in range(ns + 2):
-            dnr[j] = rrc[0] * (np.exp(dr) - 1)
-        dnr[0] = -dnr[0]
-        dnr[-1] = -dnr[-1]
-
-        # Required area factors:
-        Sbr = np.zeros((ns + 2, nr + 1))
-        for k in range(nr + 1):
-            Sbr[1:-1, k] = np.exp(2 * rg[k]) * ds * dp
-            Sbr[0, k] = Sbr[1, k]
-            Sbr[-1, k] = Sbr[-2, k]
-        Sbs = np.zeros((ns + 1, nr + 2))
-        for k in range(nr + 2):
-            for j in range(1, ns):
-                Sbs[j, k] = 0.5 * np.exp(2 * rc[k] - dr) * dp * (np.exp(2 * dr) - 1) * np.sqrt(1 - sg[j]**2)
-            Sbs[0, k] = Sbs[1, k]
-            Sbs[-1, k] = Sbs[-2, k]
-        Sbp = np.zeros((ns + 2, nr + 2))
-        for k in range(nr + 2):
-            for j in range(1, ns + 1):
-                Sbp[j, k] = 0.5 * np.exp(2 * rc[k] - dr) * (np.exp(2 * dr) - 1) * (np.arcsin(sg[j]) - np.arcsin(sg[j - 1]))
-            Sbp[0, k] = Sbp[1, k]
-            Sbp[-1, k] = Sbp[-2, k]
+        factors = _face_factors(self.grid)
+        Sbr, Sbs, Sbp = factors[3:]
 
         # Compute br*Sbr, bs*Sbs, bp*Sbp at cell centres by Stokes theorem:
         br = np.zeros((nphi + 2, ns + 2, nr + 1))
         bs = np.zeros((nphi + 2, ns + 1, nr + 2))
         bp = np.zeros((nphi + 1, ns + 2, nr + 2))
-        br[1:-1, 1:-1, :] = als[1:, :, :] - als[:-1, :, :] + alp[:, :-1, :] - alp[:, 1:, :]
-        bs[1:-1, :, 1:-1] = alp[:, :, 1:] - alp[:, :, :-1]
-        bp[:, 1:-1, 1:-1] = als[:, :, :-1] - als[:, :, 1:]
+        # (computed in place to avoid temporary arrays the size of the grid)
+        br_inner = br[1:-1, 1:-1, :]
+        np.subtract(als[1:, :, :], als[:-1, :, :], out=br_inner)
+        br_inner += alp[:, :-1, :]
+        br_inner -= alp[:, 1:, :]
+        np.subtract(alp[:, :, 1:], alp[:, :, :-1], out=bs[1:-1, :, 1:-1])
+        np.subtract(als[:, :, :-1], als[:, :, 1:], out=bp[:, 1:-1, 1:-1])
 
         # Fill ghost values with boundary conditions:
         # - zero-gradient at outer boundary:
@@ -392,25 +710,19 @@ class Output:
         bs[-1, :, :] = bs[1, :, :]
         br[0, :, :] = br[-2, :, :]
         br[-1, :, :] = br[1, :, :]
-        # js = jp = 0 at photosphere:
-        for i in range(nphi + 1):
-            bp[i, :, 0] = Sbp[:, 0] / dnp[:, 0] * (bp[i, :, 1] * dnp[:, 1] / Sbp[:, 1] + br[i, :, 0] * dnr[:] / Sbr[:, 0] - br[i + 1, :, 0] * dnr[:] / Sbr[:, 0])
-        for i in range(nphi + 2):
-            bs[i, :, 0] = Sbs[:, 0] / dns[:, 0] * (bs[i, :, 1] * dns[:, 1] / Sbs[:, 1] + br[i, :-1, 0] * dnr[:-1] / Sbr[:-1, 0] - br[i, 1:, 0] * dnr[1:] / Sbr[1:, 0])
+        _photosphere(br, bs, bp, factors)
         # - polar boundaries as in dumfric:
-        for i in range(nphi + 2):
-            i1 = (i + nphi // 2) % nphi
-            br[i, -1, :] = br[i1, -2, :]
-            br[i, 0, :] = br[i1, 1, :]
-            bs[i, -1, :] = 0.5 * (bs[i, -2, :] - bs[i1, -2, :])
-            bs[i, 0, :] = 0.5 * (bs[i, 1, :] - bs[i1, 1, :])
-        for i in range(nphi + 1):
-            i1 = (i + nphi // 2) % nphi
-            bp[i, -1, :] = -bp[i1, -2, :]
-            bp[i, 0, :] = -bp[i1, 1, :]
-
-        self._common_b_cache = br, bs, bp, Sbr, Sbs, Sbp
-        return self._common_b_cache
+        #   (the ghost cells at each pole take the values on the opposite
+        #   side of the pole)
+        i1 = (np.arange(nphi + 2) + nphi // 2) % nphi
+        br[:, -1, :] = br[i1, -2, :]
+        br[:, 0, :] = br[i1, 1, :]
+        bs[:, -1, :] = 0.5 * (bs[:, -2, :] - bs[i1, -2, :])
+        bs[:, 0, :] = 0.5 * (bs[:, 1, :] - bs[i1, 1, :])
+        bp[:, -1, :] = -bp[i1[:-1], -2, :]
+        bp[:, 0, :] = -bp[i1[:-1], 1, :]
+
+        return br, bs, bp, Sbr, Sbs, Sbp
 
     def get_bvec(self, coords, out_type="spherical"):
         """
@@ -500,3 +812,190 @@ class Output:
             ])
             bvecs = np.array([np.dot(M_.T, v) for M_, v in zip(M.T, bvecs)])
         return bvecs * self.bunit
+
+
+class SpectralOutput(_BaseOutput):
+    '''
+    Output of PFSS modelling, stored as spectral coefficients.
+
+    Instead of storing the vector potential on the whole 3D grid, this only
+    stores the eigenfunctions of the angular part of the solution and the
+    coefficients of the radial solutions for each mode. The magnetic field
+    is then computed on demand at any radius, which is much cheaper than
+    computing an `Output` if the field is only needed on a few radial shells.
+
+    Parameters
+    ----------
+    lam, Q :
+        Eigenvalues and eigenvectors of the angular part of the solution
+        for each azimuthal mode.
+    clm, dlm :
+        Coefficients of the two radial solutions for each mode.
+    grid : Grid
+        Grid that the output was calculated on.
+    input_map : sunpy.map.GenericMap
+        The input map.
+
+    Notes
+    -----
+    Instances of this class are intended to be created by
+    `sunkit_magex.pfss.pfss` with ``spectral=True``, and not by users.
+    '''
+    def __init__(self, lam, Q, clm, dlm, grid, input_map=None):
+        nm, nl = lam.shape
+        super().__init__(grid, input_map, m_max=nm - 1, n_modes=nl)
+        self._lam = lam
+        self._Q = Q
+        self._clm = clm
+        self._dlm = dlm
+
+    def _check_radii(self, r):
+        r = np.asarray(r)
+        if np.any((r < 1) | (r > self.grid.rss)):
+            raise ValueError(f'r must be between 1 and the source surface radius '
+                             f'{self.grid.rss} (got {r})')
+
+    def _br(self, radii):
+        """
+        Radial magnetic field on the radial shells at *radii*, as a
+        ``(len(radii), nphi, ns)`` shaped array.
+
+        Only psi on each shell is needed for br, so this is cheaper than
+        `bc` if only br is needed.
+        """
+        from sunkit_magex.pfss.pfss import _als_alp, _angular_factors, _psi, _radial_factors
+
+        radii = np.atleast_1d(radii).astype(float)
+        self._check_radii(radii)
+        dr = self.grid.dr
+        ns = self.grid.ns
+        nphi = self.grid.nphi
+
+        rho = np.log(radii)
+        ffp, ffm = _radial_factors(self._lam, dr)
+        psi = _psi(rho / dr, self._Q, self._clm, self._dlm, ffp, ffm, nphi)
+        Fp, Fs, _, _ = _angular_factors(self.grid)
+        als = np.zeros((nphi + 1, ns, len(radii)))
+        alp = np.zeros((nphi, ns + 1, len(radii)))
+        _als_alp(Fs, psi, Fp, als, alp)
+
+        # Compute br*Sbr by Stokes theorem, and remove area factor
+        br = als[1:] - als[:-1] + alp[:, :-1] - alp[:, 1:]
+        br /= np.exp(2 * rho) * self.grid.ds * self.grid.dp
+        return br.transpose(2, 0, 1)
+
+    def bc(self, r):
+        """
+        B on the centres of the cell faces at a given radius.
+
+        Parameters
+        ----------
+        r : float
+            Radius, as a fraction of the solar radius. Must be between 1 and
+            the source surface radius.
+
+        Returns
+        -------
+        br : astropy.units.Quantity
+            A ``nphi, ns`` shaped Quantity.
+        btheta : astropy.units.Quantity
+            A ``nphi, ns + 1`` shaped Quantity.
+        bphi : astropy.units.Quantity
+            A ``nphi + 1, ns`` shaped Quantity.
+
+        Notes
+        -----
+        The components are on the same horizontal locations as in
+        `Output.bc`. At the radii of the grid points (for ``br``) and the
+        radii of the cell centres (for ``btheta`` and ``bphi``) they are
+        equal to the values in `Output.bc`.
+        """
+        from sunkit_magex.pfss.pfss import _als_alp, _angular_factors, _psi, _radial_factors
+
+        self._check_radii(r)
+        dr = self.grid.dr
+        ds = self.grid.ds
+        dp = self.grid.dp
+        ns = self.grid.ns
+        nphi = self.grid.nphi
+        sg = self.grid.sg
+
+        # psi on this shell, and half a radial cell either side of it
+        rho = np.log(r)
+        k = rho / dr
+        ffp, ffm = _radial_factors(self._lam, dr)
+        psi = _psi(np.array([k, k - 0.5, k + 0.5]), self._Q, self._clm, self._dlm, ffp, ffm, nphi)
+        Fp, Fs, _, _ = _angular_factors(self.grid)
+        als = np.zeros((nphi + 1, ns, 3))
+        alp = np.zeros((nphi, ns + 1, 3))
+        _als_alp(Fs, psi, Fp, als, alp)
+
+        # Compute br*Sbr, bs*Sbs, bp*Sbp by Stokes theorem (see Output._common_b):
+        br = als[1:, :, 0] - als[:-1, :, 0] + alp[:, :-1, 0] - alp[:, 1:, 0]
+        bs = alp[:, :, 2] - alp[:, :, 1]
+        bp = als[:, :, 1] - als[:, :, 2]
+
+        # Remove area factors:
+        br /= np.exp(2 * rho) * ds * dp
+        Sr = 0.5 * np.exp(2 * rho - dr) * (np.exp(2 * dr) - 1)
+        Sbs = Sr * dp * np.sqrt(1 - sg**2)
+        Sbs[0] = Sbs[1]
+        Sbs[-1] = Sbs[-2]
+        bs /= Sbs
+        bp /= Sr * (np.arcsin(sg[1:]) - np.arcsin(sg[:-1]))
+
+        # - polar boundaries as in dumfric:
+        opposite = np.roll(bs, -(nphi // 2), axis=0)
+        bs[:, -1] = 0.5 * (bs[:, -2] - opposite[:, -2])
+        bs[:, 0] = 0.5 * (bs[:, 1] - opposite[:, 1])
+
+        np.negative(bs, out=bs)
+        return br << self.bunit, bs << self.bunit, bp << self.bunit
+
+    def br_map(self, r):
+        """
+        Radial magnetic field component at a given radius.
+
+        Parameters
+        ----------
+        r : float
+            Radius, as a fraction of the solar radius. Must be between 1 and
+            the source surface radius.
+
+        Returns
+        -------
+        :class:`sunpy.map.GenericMap`
+        """
+        return self._br_map(self._br(r)[0])
+
+    @property
+    def source_surface_br(self):
+        """
+        Radial magnetic field component on the source surface.
+
+        Returns
+        -------
+        :class:`sunpy.map.GenericMap`
+        """
+        return self.br_map(self.grid.rss)
+
+    def to_output(self, n_workers=1, shell_block=None, out=None, dtype=None):
+        """
+        Compute the full 3D `Output`.
+
+        Parameters
+        ----------
+        n_workers, shell_block, out, dtype :
+            See `sunkit_magex.pfss.pfss`.
+
+        Returns
+        -------
+        Output
+        """
+        from sunkit_magex.pfss.pfss import _radial_factors, _solve
+
+        ffp, ffm = _radial_factors(self._lam, self.grid.dr)
+        alr, als, alp = _solve(self.grid, self._Q, self._clm, self._dlm, ffp, ffm,
+                               n_workers=n_workers, shell_block=shell_block, out=out, dtype=dtype)
+        return Output(alr, als, alp, self.grid, self.input_map,
+                      m_max=self.m_max, n_modes=self.n_modes)
@@ -1,73 +1,472 @@
 """
 Code for calculating a PFSS extrapolation.
 """
+import concurrent.futures
+import functools
+
 import numpy as np
 
 import sunkit_magex.pfss
+import sunkit_magex.pfss.cache
+from sunkit_magex.pfss import instrumentation
+from sunkit_magex.pfss.grid import Grid
+from sunkit_magex.pfss.input import _check_br_outer
+
+
+def _compute_r_term(m, k, Q, clm, dlm, ffm, ffp, psi):
+    # - radial term for each l, keeping the real and imaginary parts in
+    #   separate real arrays so that Q does not need to be cast to complex
+    ffpk = ffp ** k[:, np.newaxis]
+    ffmk = ffm ** k[:, np.newaxis]
+    psir_real = clm.real * ffpk + dlm.real * ffmk
+    psir_imag = clm.imag * ffpk + dlm.imag * ffmk
+
+    # - compute entry for this m in psit = Sum_l c_{lm}Q_{lm}**j
+    psi[:, :, m] = np.dot(psir_real, Q.T) + 1j * np.dot(psir_imag, Q.T)
+    return psi
+
+
+def _als_alp(Fs, psi, Fp, als, alp):
+    """
+    Compute the vector potential from psi, writing it to *als* and *alp*.
+
+    psi has shape ``(nr, ns, nphi)``, *als* has shape ``(nphi + 1, ns, nr)``,
+    and *alp* has shape ``(nphi, ns + 1, nr)``.
+    """
+    # [note index order, for netcdf]
+    psi = psi.transpose(2, 1, 0)
+    # - difference in phi (periodic)
+    np.subtract(np.roll(psi, 1, axis=0), psi, out=als[:-1])
+    als[:-1] *= Fs[:, np.newaxis]
+    als[-1] = als[0]
+    # - difference in s
+    np.subtract(psi[:, 1:], psi[:, :-1], out=alp[:, 1:-1])
+    alp[:, 1:-1] *= Fp[1:-1, np.newaxis]
+    return als, alp
+
+
+# Functions that are compiled with numba if it is installed
+_NUMBA_FUNCTIONS = [_compute_r_term]
+
+
+def _numba_signatures(numba):
+    """
+    Signatures to compile each of the functions in ``_NUMBA_FUNCTIONS`` for.
+    """
+    float1d = numba.float64[:]
+    complex1d = numba.complex128[:]
+    complex3d = numba.complex128[:, :, :]
+    # Eigenfunctions from the eigenbasis cache are read-only
+    r_term = [complex3d(numba.int64, float1d, numba.types.Array(numba.float64, 2, 'C', readonly=readonly),
+                        complex1d, complex1d, float1d, float1d, complex3d)
+              for readonly in [False, True]]
+    return {_compute_r_term: r_term}
+
+
+@functools.cache
+def _has_numba():
+    try:
+        import numba  # NOQA: F401
+    except Exception:
+        return False
+    return True
+
+
+@functools.cache
+def _jit(func):
+    """
+    Compile *func* with numba if it is installed, or otherwise return it
+    unchanged.
 
-HAS_NUMBA = False
-try:
+    numba is only imported the first time this is called, and the compiled
+    functions are cached on disk so that they only need to be compiled once
+    (and not once per process).
+    """
+    if not _has_numba():
+        return func
     import numba
-    HAS_NUMBA = True
-except Exception:
-    pass
 
+    # Release the GIL so that modes can be solved in parallel threads
+    signatures = _numba_signatures(numba)[func]
+    return numba.jit(signatures, nopython=True, nogil=True, cache=True)(func)
+
+
+def __getattr__(name):
+    # Deciding whether numba is installed imports it, so only do it when
+    # it is asked for
+    if name == 'HAS_NUMBA':
+        return _has_numba()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def warmup():
+    """
+    Compile the numba-accelerated parts of `sunkit_magex.pfss.pfss` ahead of
+    time.
+
+    Otherwise these are compiled when they are first used, which can take
+    longer than solving a small input. Compiled functions are cached on disk,
+    so after the first time this only loads them from the cache. This does
+    nothing if numba is not installed.
+
+    Returns
+    -------
+    bool
+        `True` if numba is installed.
+    """
+    for func in _NUMBA_FUNCTIONS:
+        _jit(func)
+    return _has_numba()
+
+
+_METHODS = ('dense', 'tridiagonal')
+# Floating point types the vector potential can be stored in
+_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+# Maximum size of the stack of matrices passed to a single batched
+# eigensolver call
+_EIGH_BLOCK_BYTES = 2**27
+
+
+def _map_blocks(func, n, n_workers):
+    """
+    Call ``func(indices)`` on contiguous blocks of ``range(n)``, using up to
+    *n_workers* threads.
+    """
+    if n_workers < 1:
+        raise ValueError(f'n_workers must be at least 1 (got {n_workers})')
+    blocks = np.array_split(np.arange(n), min(n_workers, n))
+    if len(blocks) == 1:
+        func(blocks[0])
+        return
+    with concurrent.futures.ThreadPoolExecutor(len(blocks)) as executor:
+        # Consume the results so that any exceptions are raised here
+        list(executor.map(func, blocks))
+
+
+def _angular_factors(grid):
+    """
+    Ratios of cell edge lengths used to build the angular part of the
+    Laplacian, and to go from psi to the vector potential.
+    """
+    ns = grid.ns
+    ds = grid.ds
+    dp = grid.dp
+    sg = grid.sg
+    sc = grid.sc
+
+    Fp = np.zeros(ns + 1)  # Lp/Ls on p-ribs
+    Fp[1:-1] = np.sqrt(1 - sg[1:-1]**2) / (np.arcsin(sc[1:]) - np.arcsin(sc[:-1])) * dp
+    Vg = Fp / ds / dp
+    Fs = (np.arcsin(sg[1:]) - np.arcsin(sg[:-1])) / np.sqrt(1 - sc**2) / dp  # Ls/Lp on s-ribs
+    Uc = Fs / ds / dp
+    return Fp, Fs, Vg, Uc
+
+
+def _truncation(grid, m_max=None, n_modes=None):
+    """
+    Number of azimuthal modes and number of eigenmodes for each azimuthal
+    mode to solve for.
+    """
+    nm = grid.nphi // 2 + 1
+    nl = grid.ns
+    if m_max is not None:
+        if m_max < 0:
+            raise ValueError(f'm_max must be at least 0 (got {m_max})')
+        nm = min(nm, m_max + 1)
+    if n_modes is not None:
+        if n_modes < 1:
+            raise ValueError(f'n_modes must be at least 1 (got {n_modes})')
+        nl = min(nl, n_modes)
+    return nm, nl
+
+
+def _eigenbasis(grid, method='dense', n_workers=1, m_max=None, n_modes=None):
+    """
+    Eigenvalues and eigenvectors of the angular operator for every azimuthal
+    mode.
+
+    These only depend on ``grid.ns`` and ``grid.nphi``.
+
+    Parameters
+    ----------
+    grid : sunkit_magex.pfss.grid.Grid
+    method : {'dense', 'tridiagonal'}
+        Eigensolver to use. See `sunkit_magex.pfss.pfss` for details.
+    n_workers : int
+        Number of threads to use.
+    m_max, n_modes : int, optional
+        If given, only compute the azimuthal modes up to *m_max*, and the
+        *n_modes* eigenvectors with the smallest eigenvalues for each
+        azimuthal mode.
+
+    Returns
+    -------
+    lam : numpy.ndarray
+        ``(nm, nl)`` shaped array of eigenvalues, where ``nm`` is
+        ``nphi // 2 + 1`` and ``nl`` is ``ns`` if the modes are not truncated.
+    Q : numpy.ndarray
+        ``(nm, ns, nl)`` shaped array of eigenvectors. ``Q[m, :, l]``
+        is the eigenvector for mode ``l, m``.
+    """
+    if method not in _METHODS:
+        raise ValueError(f'method must be one of {_METHODS} (got {method!r})')
+
+    ns = grid.ns
+    nphi = grid.nphi
+    nm, nl = _truncation(grid, m_max, n_modes)
+    _, _, Vg, Uc = _angular_factors(grid)
 
-def _eigh(A):
-    return np.linalg.eigh(A)
+    # Prepare tridiagonal matrix:
+    # - term required for m-dependent part of matrix:
+    mu = np.fft.fftfreq(nphi)[:nm]
+    mu = 4 * np.sin(np.pi * mu)**2
+    # - diagonal terms for each m, and (m-independent) off-diagonal terms:
+    diag = Vg[:-1] + Vg[1:] + Uc * mu[:, np.newaxis]
+    offdiag = -Vg[1:-1]
+
+    lam = np.zeros((nm, nl))
+    Q = np.zeros((nm, ns, nl))
+
+    if method == 'tridiagonal':
+        import scipy.linalg
+
+        # Only compute the eigenvectors that are needed
+        select = {} if nl == ns else {'select': 'i', 'select_range': (0, nl - 1)}
+
+        # Only store the diagonal and off-diagonal parts of the matrix
+        def solve_modes(ms):
+            for m in ms:
+                lam[m], Q[m] = scipy.linalg.eigh_tridiagonal(diag[m], offdiag, **select)
+
+        _map_blocks(solve_modes, nm, n_workers)
+        return lam, Q
+
+    # Solve for blocks of modes at once, with one batched call to
+    # the eigensolver for each block.
+    # (note that A is symmetric so use special solver)
+    j = np.arange(ns)
+    block = max(1, _EIGH_BLOCK_BYTES // (8 * ns**2))
+
+    def solve_blocks(blocks):
+        for m0 in blocks:
+            m1 = min(m0 + block, nm)
+            A = np.zeros((m1 - m0, ns, ns))
+            A[:, j, j] = diag[m0:m1]
+            A[:, j[:-1], j[1:]] = offdiag
+            A[:, j[1:], j[:-1]] = offdiag
+            # - compute eigenvectors Q_{lm} and eigenvalues lam_{lm}:
+            #   (eigh always computes all of them, so drop any that aren't needed)
+            w, v = np.linalg.eigh(A)
+            lam[m0:m1] = w[:, :nl]
+            Q[m0:m1] = v[:, :, :nl]
+
+    block_starts = np.arange(0, nm, block)
+    _map_blocks(lambda idx: solve_blocks(block_starts[idx]), len(block_starts), n_workers)
+    return lam, Q
+
+
+def _project(lam, Q, br):
+    """
+    Project a stack of boundary conditions onto the eigenvectors of each
+    azimuthal mode.
 
+    Parameters
+    ----------
+    lam, Q : numpy.ndarray
+        Eigenbasis, as returned by ``_eigenbasis``.
+    br : numpy.ndarray
+        ``(nmaps, ns, nphi)`` shaped stack of boundary conditions.
 
-def _compute_r_term(m, k, ns, Q, brt, lam, ffm, nr, ffp, psi, psir, rss, brt_outer):
-    for l in range(ns):
-        # Ignore the l=0 and m=0 term; for a globally divergence free field
-        # this term is zero anyway, but numerically it may be small which
-        # causes numerical issues when solving for c, d
-        if l == 0 and m == 0:
-            continue
-        # - sum (c_{lm} + d_{lm}) * lam_{l}
+    Returns
+    -------
+    cdlm : numpy.ndarray
+        ``(nmaps, nm, nl)`` shaped array of :math:`c_{lm} + d_{lm}` for
+        each map, for the modes in the eigenbasis.
+    """
+    # FFT in phi of each distribution at each latitude:
+    # (dropping any azimuthal modes that aren't in the eigenbasis)
+    with instrumentation._stage('fft'):
+        brt = np.fft.rfft(br, axis=-1)[..., :Q.shape[0]].astype(np.complex128)
+    brt = brt.transpose(2, 0, 1)
+    # - sum (c_{lm} + d_{lm}) * lam_{l}
+    #   (one batched matrix-matrix product for all maps and modes at once,
+    #   keeping real and imaginary parts separate to avoid a complex copy of Q)
+    with instrumentation._stage('projection'):
+        cdlm = np.matmul(brt.real, Q) + 1j * np.matmul(brt.imag, Q)
+        cdlm = np.ascontiguousarray(cdlm.transpose(1, 0, 2))
+    # The l=0 and m=0 term is excluded from the solution (see _compute_r_term)
+    with np.errstate(divide='ignore', invalid='ignore'):
         # lam[l] is small so this blows up
-        cdlm = np.dot(Q[:, l], np.asfortranarray(brt[:, m])) / lam[l]
+        cdlm /= lam
+    cdlm[:, 0, 0] = 0
+    return cdlm
 
-        if brt_outer is None:
-            # - ratio c_{lm}/d_{lm} [numerically safer this way up]
-            ratio = (ffm[l]**(nr - 1) - ffm[l]**nr) / (ffp[l]**nr - ffp[l]**(nr - 1))
-            dlm = cdlm / (1.0 + ratio)
-            clm = ratio * dlm
-        else:
-            cdlm1 = np.dot(Q[:, l], np.asfortranarray(brt_outer[:, m])) / lam[l] * rss ** 2
-            clm = (cdlm1 - ffm[l] ** nr * cdlm) / (ffp[l] ** nr - ffm[l] ** nr)
-            dlm = (cdlm1 - ffp[l] ** nr * cdlm) / (ffm[l] ** nr - ffp[l] ** nr)
 
-        psir[:, l] = clm * ffp[l]**k + dlm * ffm[l]**k
+def _radial_factors(lam, dr):
+    """
+    Growth factors per radial cell of the two radial solutions for each
+    eigenvalue.
+    """
+    # - solve quadratic:
+    e1 = np.exp(dr)
+    fact = np.sinh(dr) * (e1 - 1)
+    Flm = 0.5 * (1 + e1 + lam * fact)
+    ffp = Flm + np.sqrt(Flm**2 - e1)
+    ffm = e1 / ffp
+    return ffp, ffm
 
-    # - compute entry for this m in psit = Sum_l c_{lm}Q_{lm}**j
-    psi[:, :, m] = np.dot(psir, Q.T)
-    return psi, psir
+
+def _coefficients(cdlm, cdlm_outer, ffp, ffm, nr):
+    """
+    Coefficients :math:`c_{lm}, d_{lm}` of the two radial solutions for each
+    mode, given the projections of the inner (and optionally outer) boundary
+    conditions.
+    """
+    # Ignore the l=0 and m=0 term; for a globally divergence free field
+    # this term is zero anyway, but numerically it may be small which
+    # causes numerical issues when solving for c, d
+    # (cdlm is set to zero for this term in _project, which gives clm = dlm = 0)
+    if cdlm_outer is None:
+        # - ratio c_{lm}/d_{lm} [numerically safer this way up]
+        ratio = (ffm**(nr - 1) - ffm**nr) / (ffp**nr - ffp**(nr - 1))
+        dlm = cdlm / (1.0 + ratio)
+        clm = ratio * dlm
+    else:
+        clm = (cdlm_outer - ffm ** nr * cdlm) / (ffp ** nr - ffm ** nr)
+        dlm = (cdlm_outer - ffp ** nr * cdlm) / (ffm ** nr - ffp ** nr)
+    return clm, dlm
 
 
-def _als_alp(nr, nphi, Fs, psi, Fp, als, alp):
-    for j in range(nr + 1):
-        for i in range(nphi + 1):
-            als[i, :, j] = Fs * (psi[j, :, ((i - 1) % nphi)] - psi[j, :, ((i) % nphi)])
-        for i in range(nphi):
-            alp[i, 1:-1, j] = Fp[1:-1] * (psi[j, 1:, i] - psi[j, :-1, i])
-    return als, alp
+def _psi(k, Q, clm, dlm, ffp, ffm, nphi, n_workers=1):
+    """
+    Compute psi on the radial shells with (not necessarily integer) indices
+    *k*.
+
+    Returns
+    -------
+    psi : numpy.ndarray
+        ``(len(k), ns, nphi)`` shaped array.
+    """
+    import scipy.fft
+
+    nm = clm.shape[0]
+    ns = Q.shape[1]
+    # - initialise:
+    #   (only the positive modes are stored, since psi is real, and any
+    #   modes above nm are zero)
+    psi = np.zeros((len(k), ns, nm), dtype='complex')
+
+    # (the compiled function needs each Q[m] to be contiguous)
+    Q = np.ascontiguousarray(Q)
+    compute_r_term = _jit(_compute_r_term)
 
+    # Each azimuthal mode only writes to its own slices of psi, so blocks of
+    # modes can be solved in parallel
+    def solve_modes(ms):
+        for m in ms:
+            # - compute radial term for each l (for this m):
+            compute_r_term(m, k, Q[m], clm[m], dlm[m], ffm[m], ffp[m], psi)
 
-def _A_diag(A, ns, Vg, Uc, mu, m):
-    for j in range(ns):
-        A[j, j] = Vg[j] + Vg[j + 1] + Uc[j] * mu[m]
-    return A
+    # Loop over azimuthal modes (positive m):
+    with instrumentation._stage('radial_terms'):
+        _map_blocks(solve_modes, nm, n_workers)
 
+    # Compute psi by inverse real fft:
+    # (which pads any missing high modes with zeros)
+    with instrumentation._stage('inverse_fft'):
+        return scipy.fft.irfft(psi, n=nphi, axis=2, overwrite_x=True, workers=n_workers)
 
-if HAS_NUMBA:
-    _eigh = numba.jit(nopython=True)(_eigh)
-    _compute_r_term = numba.jit(nopython=True)(_compute_r_term)
-    _als_alp = numba.jit(nopython=True)(_als_alp)
-    _A_diag = numba.jit(nopython=True)(_A_diag)
 
+def _cached_eigenbasis(grid, method, n_workers, m_max, n_modes):
+    """
+    Get the eigenbasis for a grid from `sunkit_magex.pfss.cache.eigenbasis_cache`,
+    or the cache used instead of it in this thread.
+    """
+    lam, Q = sunkit_magex.pfss.cache._current_eigenbasis_cache().get(grid, method, n_workers=n_workers,
+                                                                     m_max=m_max, n_modes=n_modes)
+    # The cached eigenbasis might have more modes than were asked for
+    return np.ascontiguousarray(lam), np.ascontiguousarray(Q)
+
+
+def _storage_dtype(dtype, out):
+    """
+    Floating point type to store the vector potential in, given the *dtype*
+    and *out* arguments to `pfss`.
+    """
+    if out is not None:
+        out_dtypes = {np.dtype(arr.dtype) for arr in out}
+        if len(out_dtypes) != 1:
+            raise ValueError('out arrays must have the same dtype')
+        out_dtype = out_dtypes.pop()
+        if dtype is not None and np.dtype(dtype) != out_dtype:
+            raise ValueError(f'dtype ({np.dtype(dtype)}) does not match the dtype '
+                             f'of the out arrays ({out_dtype})')
+        dtype = out_dtype
+    if dtype is None:
+        return np.dtype(np.float64)
+    dtype = np.dtype(dtype)
+    if dtype not in _DTYPES:
+        raise ValueError(f'dtype must be float32 or float64 (got {dtype})')
+    return dtype
+
+
+def _solve(grid, Q, clm, dlm, ffp, ffm, n_workers=1, shell_block=None, out=None, dtype=None):
+    """
+    Compute the vector potential from the eigenvectors and radial coefficients.
+
+    psi and the vector potential are computed for blocks of *shell_block*
+    radial shells at a time, so the memory needed for psi is proportional
+    to the size of the block rather than the whole volume. If given, *out*
+    is a tuple of ``(als, alp)`` arrays that the vector potential is
+    written to. The vector potential is always computed in double precision,
+    and only rounded to *dtype* when it is stored.
+    """
+    nr = grid.nr
+    ns = grid.ns
+    nphi = grid.nphi
+
+    Fp, Fs, _, _ = _angular_factors(grid)
+    k = np.linspace(0, nr, nr + 1)
+    if shell_block is None:
+        shell_block = nr + 1
+    if shell_block < 1:
+        raise ValueError(f'shell_block must be at least 1 (got {shell_block})')
 
-def pfss(input):
+    dtype = _storage_dtype(dtype, out)
+    # Hence compute vector potential [note index order, for netcdf]:
+    # (note that alr is zero by definition)
+    alr = np.zeros((nphi + 1, ns + 1, nr), dtype=dtype)
+    if out is None:
+        als = np.zeros((nphi + 1, ns, nr + 1), dtype=dtype)
+        alp = np.zeros((nphi, ns + 1, nr + 1), dtype=dtype)
+    else:
+        als, alp = out
+        if als.shape != (nphi + 1, ns, nr + 1) or alp.shape != (nphi, ns + 1, nr + 1):
+            raise ValueError(f'out arrays must have shapes {(nphi + 1, ns, nr + 1)} '
+                             f'and {(nphi, ns + 1, nr + 1)} '
+                             f'(got {als.shape} and {alp.shape})')
+        # The poles are never written to below
+        alp[:, 0, :] = 0
+        alp[:, -1, :] = 0
+
+    for j0 in range(0, nr + 1, shell_block):
+        j1 = min(j0 + shell_block, nr + 1)
+        psi = _psi(k[j0:j1], Q, clm, dlm, ffp, ffm, nphi, n_workers)
+        # Past this point only psi, Fs, Fp are needed
+        with instrumentation._stage('als_alp'):
+            if dtype == np.float64:
+                _als_alp(Fs, psi, Fp, als[:, :, j0:j1], alp[:, :, j0:j1])
+            else:
+                als_block, alp_block = _als_alp(Fs, psi, Fp, np.empty((nphi + 1, ns, j1 - j0)),
+                                                np.zeros((nphi, ns + 1, j1 - j0)))
+                als[:, :, j0:j1] = als_block
+                alp[:, :, j0:j1] = alp_block
+
+    return alr, als, alp
+
+
+def pfss(input, method='dense', n_workers=1, shell_block=None, out=None, spectral=False,
+         m_max=None, n_modes=None, dtype=None):
     r"""
     Compute PFSS model.
 
@@ -80,13 +479,66 @@ def pfss(input):
     ----------
     input : ~sunkit_magex.pfss.Input
         Input parameters.
+    method : {'dense', 'tridiagonal'}
+        Eigensolver used for the angular part of the solution. The matrix
+        being solved is symmetric tridiagonal; ``'dense'`` solves the full
+        matrix with `numpy.linalg.eigh`, and ``'tridiagonal'`` only stores the
+        diagonal and off-diagonal and uses `scipy.linalg.eigh_tridiagonal`,
+        which is faster and uses less memory for large grids. Both methods
+        give the same solution to within floating point precision.
+    n_workers : int
+        Number of threads used to solve for the azimuthal modes, which are
+        independent of each other, and to compute the inverse Fourier
+        transform in :math:`\phi`. The output is identical to the output
+        computed with a single thread.
+    shell_block : int, optional
+        If given, compute the solution for this many radial shells at a time.
+        This limits the amount of memory needed for intermediate arrays to
+        be proportional to the size of a block of shells instead of the whole
+        grid. By default all shells are computed at once.
+    out : tuple of numpy.ndarray, optional
+        If given, a tuple of ``(als, alp)`` arrays with shapes
+        ``(nphi + 1, ns, nr + 1)`` and ``(nphi, ns + 1, nr + 1)`` that the
+        vector potential is written to. Together with *shell_block*, passing
+        memory-mapped arrays (e.g. created with `numpy.lib.format.open_memmap`)
+        allows solving on grids that are too large to fit in memory.
+    spectral : bool
+        If `True`, return a `~sunkit_magex.pfss.SpectralOutput`, which only
+        stores the spectral coefficients of the solution and evaluates the
+        magnetic field on demand at any radius. This is much cheaper if the
+        field is only needed on a few radial shells.
+    m_max : int, optional
+        If given, only solve for azimuthal modes with :math:`m \leq m_{max}`.
+        The higher modes are not computed at all, which is faster than
+        smoothing the input map and then solving for every mode.
+    n_modes : int, optional
+        If given, only solve for the *n_modes* latitudinal eigenmodes with
+        the largest length scales (i.e. the smallest eigenvalues) for each
+        azimuthal mode. With ``method='tridiagonal'`` the other eigenmodes
+        are not computed at all.
+    dtype : {`numpy.float64`, `numpy.float32`}, optional
+        Floating point type used to store the vector potential, and the
+        magnetic field arrays derived from it (e.g.
+        `~sunkit_magex.pfss.Output.bg`). The solution is always computed in
+        double precision and only rounded when it is stored, so
+        ``numpy.float32`` halves the memory used by the output at the cost of
+        a small loss of accuracy (see :ref:`float32-storage`). Defaults to
+        ``numpy.float64``, or the dtype of the *out* arrays if they are
+        given.
 
     Returns
     -------
-    ~sunkit_magex.pfss.Output
+    ~sunkit_magex.pfss.Output or ~sunkit_magex.pfss.SpectralOutput
+
+    See Also
+    --------
+    pfss_batch : Compute several PFSS models that share a grid.
 
     Notes
     -----
+    The time and memory used by each stage of the calculation can be
+    recorded using `sunkit_magex.pfss.instrumentation`.
+
     In order to avoid numerical issues, the monopole term (which should be zero
     for a physical magnetic field anyway) is explicitly excluded from the
     solution.
@@ -94,88 +546,263 @@ def pfss(input):
     The output should have zero current to machine precision,
     when computed with the DuMFriC staggered discretization.
     """
-    br0 = input.br
-    nr = input.grid.nr
-    ns = input.grid.ns
-    nphi = input.grid.nphi
-    rss = input.grid.rss
+    return pfss_batch([input], method=method, n_workers=n_workers,
+                      shell_block=shell_block, out=None if out is None else [out],
+                      spectral=spectral, m_max=m_max, n_modes=n_modes, dtype=dtype)[0]
 
-    # Coordinates:
-    ds = input.grid.ds
-    dp = input.grid.dp
-    dr = input.grid.dr
 
-    input.grid.rg
-    input.grid.rc
+def pfss_batch(inputs, method='dense', n_workers=1, shell_block=None, out=None, spectral=False,
+               m_max=None, n_modes=None, dtype=None):
+    r"""
+    Compute PFSS models for several inputs that share the same grid.
 
-    sg = input.grid.sg
-    sc = input.grid.sc
+    The eigenfunctions of the angular part of the solution only depend on
+    the number of grid points in :math:`s` and :math:`\phi`. This computes
+    them once, and projects all of the boundary conditions onto them together,
+    which is much faster than calling `~sunkit_magex.pfss.pfss` on each input
+    in turn (e.g. for the different realizations in an ADAPT map, or a time
+    series of magnetograms).
 
-    br_outer = input.br_outer
+    The eigenfunctions are stored in `sunkit_magex.pfss.cache.eigenbasis_cache`,
+    so subsequent calls on the same grid do not need to recompute them.
 
-    k = np.linspace(0, nr, nr + 1)
+    Parameters
+    ----------
+    inputs : list of ~sunkit_magex.pfss.Input
+        Input parameters. All inputs must have the same ``ns`` and ``nphi``,
+        but can have different values of ``nr`` and ``rss``.
+    method : {'dense', 'tridiagonal'}
+        Eigensolver used for the angular part of the solution. See
+        `~sunkit_magex.pfss.pfss` for details.
+    n_workers : int
+        Number of threads used to solve for the azimuthal modes. See
+        `~sunkit_magex.pfss.pfss` for details.
+    shell_block : int, optional
+        Number of radial shells to compute at a time. See
+        `~sunkit_magex.pfss.pfss` for details.
+    out : list of tuple of numpy.ndarray, optional
+        If given, one tuple of ``(als, alp)`` arrays for each input that the
+        vector potential is written to. See `~sunkit_magex.pfss.pfss` for
+        details.
+    spectral : bool
+        If `True`, return `~sunkit_magex.pfss.SpectralOutput` objects. See
+        `~sunkit_magex.pfss.pfss` for details.
+    m_max, n_modes : int, optional
+        Only solve for a subset of the modes. See `~sunkit_magex.pfss.pfss`
+        for details.
+    dtype : {`numpy.float64`, `numpy.float32`}, optional
+        Floating point type used to store the outputs. See
+        `~sunkit_magex.pfss.pfss` for details.
 
-    Fp = sg * 0  # Lp/Ls on p-ribs
-    Fp[1:-1] = np.sqrt(1 - sg[1:-1]**2) / (np.arcsin(sc[1:]) - np.arcsin(sc[:-1])) * dp
-    Vg = Fp / ds / dp
-    Fs = (np.arcsin(sg[1:]) - np.arcsin(sg[:-1])) / np.sqrt(1 - sc**2) / dp  # Ls/Lp on s-ribs
-    Uc = Fs / ds / dp
+    Returns
+    -------
+    list of ~sunkit_magex.pfss.Output or ~sunkit_magex.pfss.SpectralOutput
+        One output for each input, in the same order as *inputs*.
 
-    # FFT in phi of photospheric distribution at each latitude:
-    brt = np.fft.rfft(br0, axis=1)
-    brt = brt.astype(np.complex128)
+    See Also
+    --------
+    pfss
+    """
+    inputs = list(inputs)
+    if len(inputs) == 0:
+        return []
+    grid = inputs[0].grid
+    for input in inputs[1:]:
+        if (input.grid.ns, input.grid.nphi) != (grid.ns, grid.nphi):
+            raise ValueError('All inputs must have the same number of grid '
+                             'points in latitude and longitude')
+    if spectral and out is not None:
+        raise ValueError('out cannot be given if spectral=True')
+    if spectral and dtype is not None:
+        raise ValueError('dtype cannot be given if spectral=True')
+    # Check the storage type before doing any of the work
+    for arrays in [None] if out is None else out:
+        _storage_dtype(dtype, arrays)
+    if out is not None and len(out) != len(inputs):
+        raise ValueError(f'out must have one entry for each input (got {len(out)} '
+                         f'entries for {len(inputs)} inputs)')
+
+    # Stages that are shared by all the inputs
+    shared_report = instrumentation.Report()
+    with instrumentation._collect(shared_report):
+        lam, Q = _cached_eigenbasis(grid, method, n_workers, m_max, n_modes)
+        cdlm = _project(lam, Q, np.stack([input.br for input in inputs]))
+
+        has_outer = [isinstance(input.br_outer, np.ndarray) for input in inputs]
+        if any(has_outer):
+            cdlm_outer = _project(lam, Q, np.stack([input.br_outer for input, outer in zip(inputs, has_outer) if outer]))
+            cdlm_outer = iter(cdlm_outer)
+
+    outputs = []
+    for i, input in enumerate(inputs):
+        report = instrumentation.Report(shared_report.records)
+        with instrumentation._collect(report):
+            outer = None
+            if has_outer[i]:
+                outer = next(cdlm_outer) * input.grid.rss**2
+            ffp, ffm = _radial_factors(lam, input.grid.dr)
+            clm, dlm = _coefficients(cdlm[i], outer, ffp, ffm, input.grid.nr)
+            if spectral:
+                output = sunkit_magex.pfss.SpectralOutput(lam, Q, clm, dlm, input.grid, input.map)
+            else:
+                alr, als, alp = _solve(input.grid, Q, clm, dlm, ffp, ffm, n_workers=n_workers,
+                                       shell_block=shell_block, out=None if out is None else out[i],
+                                       dtype=dtype)
+                output = sunkit_magex.pfss.Output(alr, als, alp, input.grid, input.map,
+                                                  m_max=lam.shape[0] - 1, n_modes=lam.shape[1])
+        output.report = report
+        outputs.append(output)
+    return outputs
+
+
+def pfss_surface(input, radii=None, method='dense', n_workers=1, m_max=None, n_modes=None):
+    r"""
+    Compute the radial magnetic field of a PFSS model on spherical shells.
 
-    if isinstance(br_outer, np.ndarray):
-        brt_outer = np.fft.rfft(br_outer, axis=1)
-        brt_outer = brt_outer.astype(np.complex128)
-    else:
-        brt_outer = None
+    This only evaluates the solution on the requested shells, so it is much
+    faster and uses much less memory than computing the full 3D solution with
+    `~sunkit_magex.pfss.pfss` and then taking a slice of it (e.g. with
+    `~sunkit_magex.pfss.Output.source_surface_br`).
 
-    # Prepare tridiagonal matrix:
-    # - create off-diagonal part of the matrix:
-    A = np.zeros((ns, ns))
-    for j in range(ns - 1):
-        A[j, j + 1] = -Vg[j + 1]
-        A[j + 1, j] = A[j, j + 1]
-    # - term required for m-dependent part of matrix:
-    mu = np.fft.fftfreq(nphi)
-    mu = 4 * np.sin(np.pi * mu)**2
-    # - initialise:
-    psir = np.zeros((nr + 1, ns), dtype='complex')
-    psi = np.zeros((nr + 1, ns, nphi), dtype='complex')
-    e1 = np.exp(dr)
-    fact = np.sinh(dr) * (e1 - 1)
+    Parameters
+    ----------
+    input : ~sunkit_magex.pfss.Input
+        Input parameters.
+    radii : list of float, optional
+        Radii to compute the field at, as a fraction of the solar radius.
+        Each must be between 1 and the source surface radius. Defaults to
+        just the source surface radius.
+    method, n_workers, m_max, n_modes :
+        See `~sunkit_magex.pfss.pfss` for details.
 
-    # Loop over azimuthal modes (positive m):
-    for m in range(nphi // 2 + 1):
-        # - set diagonal terms of matrix:
-        A = _A_diag(A, ns, Vg, Uc, mu, m)
+    Returns
+    -------
+    list of sunpy.map.GenericMap
+        A map of :math:`B_{r}` for each radius, in the same order as *radii*.
+
+    See Also
+    --------
+    pfss
+    """
+    if radii is None:
+        radii = [input.grid.rss]
+    output = pfss(input, method=method, n_workers=n_workers, spectral=True,
+                  m_max=m_max, n_modes=n_modes)
+    return [output._br_map(br) for br in output._br(radii)]
 
-        # - compute eigenvectors Q_{lm} and eigenvalues lam_{lm}:
-        #   (note that A is symmetric so use special solver)
-        lam, Q = _eigh(A)
-        Q = Q.astype(np.complex128)
-        # - solve quadratic:
-        Flm = 0.5 * (1 + e1 + lam * fact)
-        ffp = Flm + np.sqrt(Flm**2 - e1)
-        ffm = e1 / ffp
 
-        # - compute radial term for each l (for this m):
-        psi, psir = _compute_r_term(m, k, ns, Q, brt, lam, ffm, nr, ffp, psi, psir, rss, brt_outer)
+def pfss_rss_sweep(input, rss_values, method='dense', n_workers=1, m_max=None, n_modes=None):
+    r"""
+    Compute PFSS models of the same input for several source surface radii.
 
-        if (m > 0):
-            psi[:, :, nphi - m] = np.conj(psi[:, :, m])
+    Only the radial part of the solution depends on the source surface
+    radius, so the angular eigenfunctions and the projection of the
+    boundary conditions onto them are computed once and shared by all of the
+    models.
 
-    # Past this point only psi, Fs, Fp are needed
-    # Compute psi by inverse fft:
-    psi = np.real(np.fft.ifft(psi, axis=2))
+    Parameters
+    ----------
+    input : ~sunkit_magex.pfss.Input
+        Input parameters. The source surface radius of the input is not used.
+    rss_values : list of float
+        Source surface radii, as a fraction of the solar radius.
+    method, n_workers, m_max, n_modes :
+        See `~sunkit_magex.pfss.pfss` for details.
 
-    # Hence compute vector potential [note index order, for netcdf]:
-    # (note that alr is zero by definition)
-    alr = np.zeros((nphi + 1, ns + 1, nr))
-    als = np.zeros((nphi + 1, ns, nr + 1))
-    alp = np.zeros((nphi, ns + 1, nr + 1))
+    Returns
+    -------
+    list of ~sunkit_magex.pfss.SpectralOutput
+        One output for each source surface radius, in the same order as
+        *rss_values*. Each output only stores the spectral coefficients of
+        the solution, so e.g. the source surface maps can be computed cheaply
+        with ``[output.source_surface_br for output in outputs]``. The full 3D
+        solution for any of the radii can be computed with
+        `~sunkit_magex.pfss.SpectralOutput.to_output`.
+
+    See Also
+    --------
+    pfss
+    """
+    rss_values = list(rss_values)
+    for rss in rss_values:
+        if rss <= 1:
+            raise ValueError(f'rss values must be greater than 1 (got {rss})')
+
+    grid = input.grid
+    report = instrumentation.Report()
+    with instrumentation._collect(report):
+        lam, Q = _cached_eigenbasis(grid, method, n_workers, m_max, n_modes)
+        cdlm = _project(lam, Q, input.br[np.newaxis])[0]
+        cdlm_outer = None
+        if isinstance(input.br_outer, np.ndarray):
+            cdlm_outer = _project(lam, Q, input.br_outer[np.newaxis])[0]
+
+    outputs = []
+    for rss in rss_values:
+        rss_grid = Grid(grid.ns, grid.nphi, grid.nr, rss)
+        ffp, ffm = _radial_factors(lam, rss_grid.dr)
+        outer = None if cdlm_outer is None else cdlm_outer * rss**2
+        clm, dlm = _coefficients(cdlm, outer, ffp, ffm, rss_grid.nr)
+        output = sunkit_magex.pfss.SpectralOutput(lam, Q, clm, dlm, rss_grid, input.map)
+        output.report = instrumentation.Report(report.records)
+        outputs.append(output)
+    return outputs
+
+
+def pfss_outer_sweep(input, br_outers, method='dense', n_workers=1, m_max=None, n_modes=None):
+    r"""
+    Compute PFSS models of the same input for several outer boundary
+    conditions.
 
-    als, alp = _als_alp(nr, nphi, Fs, psi, Fp, als, alp)
+    The projection of the inner boundary condition onto the angular
+    eigenfunctions is computed once and shared by all of the models, and
+    the outer boundary conditions are projected together, which is much
+    faster than solving for each outer boundary condition separately
+    (e.g. for an ensemble of outer boundary conditions from heliospheric
+    data assimilation).
 
-    return sunkit_magex.pfss.Output(alr, als, alp, input.grid, input.map)
+    Parameters
+    ----------
+    input : ~sunkit_magex.pfss.Input
+        Input parameters. The outer boundary condition of the input is not
+        used.
+    br_outers : list of sunpy.map.GenericMap
+        Boundary conditions of radial magnetic field at the outer surface.
+        Each must have the same dimensions as the input map.
+    method, n_workers, m_max, n_modes :
+        See `~sunkit_magex.pfss.pfss` for details.
+
+    Returns
+    -------
+    list of ~sunkit_magex.pfss.SpectralOutput
+        One output for each outer boundary condition, in the same order as
+        *br_outers*. The full 3D solution for any of them can be computed
+        with `~sunkit_magex.pfss.SpectralOutput.to_output`.
+
+    See Also
+    --------
+    pfss
+    pfss_rss_sweep
+    """
+    br_outers = list(br_outers)
+    for br_outer in br_outers:
+        _check_br_outer(input.map, br_outer)
+    if len(br_outers) == 0:
+        return []
+
+    grid = input.grid
+    report = instrumentation.Report()
+    with instrumentation._collect(report):
+        lam, Q = _cached_eigenbasis(grid, method, n_workers, m_max, n_modes)
+        cdlm = _project(lam, Q, input.br[np.newaxis])[0]
+        cdlm_outer = _project(lam, Q, np.stack([br_outer.data for br_outer in br_outers]))
+    cdlm_outer *= grid.rss**2
+    ffp, ffm = _radial_factors(lam, grid.dr)
+
+    outputs = []
+    for outer in cdlm_outer:
+        clm, dlm = _coefficients(cdlm, outer, ffp, ffm, grid.nr)
+        output = sunkit_magex.pfss.SpectralOutput(lam, Q, clm, dlm, grid, input.map)
+        output.report = instrumentation.Report(report.records)
+        outputs.append(output)
+    return outputs
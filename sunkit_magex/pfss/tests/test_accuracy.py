@@ -0,0 +1,126 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import sunkit_magex.pfss
+from sunkit_magex.pfss import accuracy, cache
+from sunkit_magex.pfss.grid import Grid
+
+
+@pytest.fixture(scope='module')
+def results():
+    return accuracy.sweep([10, 20], [30], [60], interpolation=['bc', 'bg'], step_size=[0.1, 1], n_seeds=4)
+
+
+def test_sweep(results):
+    assert len(results) == 8
+    for result in results:
+        assert 0 < result.field_error < 0.2
+        assert 0 < result.trace_error < 0.1
+        assert result.error == max(result.field_error, result.trace_error)
+        assert result.time > 0
+        assert result.memory > 0
+
+    # Smaller steps trace field lines more accurately
+    fine, coarse = results[0], results[1]
+    assert fine.step_size == 0.1
+    assert coarse.step_size == 1
+    assert fine.trace_error < coarse.trace_error
+
+
+@pytest.mark.parametrize('interpolation', accuracy.INTERPOLATIONS)
+def test_evaluate(interpolation):
+    result = accuracy.evaluate(10, 30, 60, interpolation=interpolation, l=1, m=1)
+    assert result.field_error < 0.2
+    assert np.isnan(result.trace_error)
+    assert result.error == result.field_error
+
+
+def test_evaluate_float32():
+    result = accuracy.evaluate(10, 30, 60, interpolation='bg', dtype=np.float32)
+    assert result.dtype == 'float32'
+    # Storing the output in single precision makes a negligible difference
+    # compared to the discretization error
+    expected = accuracy.evaluate(10, 30, 60, interpolation='bg')
+    assert result.field_error == pytest.approx(expected.field_error, rel=1e-4)
+
+
+def test_evaluate_state():
+    # The cache used by the rest of the process is left alone
+    grid = Grid(30, 60, 10, 2.5)
+    cache.eigenbasis_cache.clear()
+    cache.eigenbasis_cache.get(grid)
+    info = cache.eigenbasis_cache.info()
+    accuracy.evaluate(10, 30, 60)
+    assert cache.eigenbasis_cache.info() == info
+
+    # And so is the peak memory recorded by tracemalloc
+    tracemalloc.start()
+    try:
+        data = np.ones(10**7)
+        del data
+        start_peak = tracemalloc.get_traced_memory()[1]
+        result = accuracy.evaluate(10, 30, 60)
+        assert tracemalloc.is_tracing()
+        assert tracemalloc.get_traced_memory()[1] >= start_peak
+    finally:
+        tracemalloc.stop()
+    assert result.memory > 0
+
+
+def test_evaluate_warmup(monkeypatch):
+    # Compiling and the first solve happen before timing starts
+    calls = []
+    pfss = sunkit_magex.pfss.pfss
+
+    def record_pfss(*args, **kwargs):
+        calls.append('pfss')
+        return pfss(*args, **kwargs)
+
+    def record_timer():
+        calls.append('timer')
+        return 0.0
+
+    monkeypatch.setattr(sunkit_magex.pfss, 'warmup', lambda: calls.append('warmup'))
+    monkeypatch.setattr(sunkit_magex.pfss, 'pfss', record_pfss)
+    monkeypatch.setattr(accuracy.time, 'perf_counter', record_timer)
+    accuracy.evaluate(10, 30, 60)
+    assert calls == ['warmup', 'pfss', 'timer', 'pfss', 'timer']
+
+
+def test_evaluate_bad_interpolation():
+    with pytest.raises(ValueError, match='interpolation must be one of'):
+        accuracy.evaluate(10, 30, 60, interpolation='nearest')
+
+
+@pytest.mark.parametrize('cost', ['time', 'memory'])
+def test_pareto_front(results, cost):
+    front = accuracy.pareto_front(results, cost)
+    assert front
+    costs = [getattr(result, cost) for result in front]
+    errors = [result.error for result in front]
+    assert costs == sorted(costs)
+    assert errors == sorted(errors, reverse=True)
+    # Nothing on the front is beaten in both cost and error
+    for result in front:
+        assert not any(getattr(other, cost) <= getattr(result, cost) and other.error < result.error
+                       for other in results)
+
+
+def test_cheapest(results):
+    tolerance = np.median([result.error for result in results])
+    best = accuracy.cheapest(results, tolerance)
+    assert best.error <= tolerance
+    assert best in accuracy.pareto_front(results)
+    assert all(result.time >= best.time for result in results if result.error <= tolerance)
+    assert accuracy.cheapest(results, 0) is None
+
+
+def test_main(capsys):
+    results = accuracy.main(['--nr', '10', '--ns', '30', '--nphi', '60', '--l', '1', '--m', '0',
+                             '--tolerance', '1'])
+    assert len(results) == 1
+    printed = capsys.readouterr().out
+    assert 'Pareto front (error against time)' in printed
+    assert 'Cheapest configuration with error <= 1' in printed
@@ -0,0 +1,287 @@
+import concurrent.futures
+import pickle
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import sunkit_magex.pfss
+from sunkit_magex.pfss.cache import (
+    EigenbasisCache,
+    FieldCache,
+    _current_eigenbasis_cache,
+    _use_eigenbasis_cache,
+    eigenbasis_cache,
+)
+from sunkit_magex.pfss.grid import Grid
+from sunkit_magex.pfss.pfss import _eigenbasis
+
+
+@pytest.fixture
+def grids():
+    return [Grid(10, 20, 5, 2.5), Grid(12, 20, 5, 2.5), Grid(10, 24, 5, 2.5)]
+
+
+def test_lru(grids):
+    cache = EigenbasisCache(maxsize=2)
+    cache.warm(*grids)
+    info = cache.info()
+    assert info.misses == 3
+    assert info.hits == 0
+    assert info.currsize == 2
+    assert info.keys == [(12, 20, 'dense'), (10, 24, 'dense')]
+
+    # Same shape but different nr, rss uses the same eigenbasis
+    lam, Q = cache.get(Grid(12, 20, 10, 2))
+    assert cache.info().hits == 1
+    assert cache.info().keys == [(10, 24, 'dense'), (12, 20, 'dense')]
+    assert cache.info().nbytes == lam.nbytes + Q.nbytes + sum(arr.nbytes for arr in cache.get(grids[2]))
+
+    expected_lam, expected_Q = _eigenbasis(grids[1])
+    np.testing.assert_equal(lam, expected_lam)
+    np.testing.assert_equal(Q, expected_Q)
+    assert not Q.flags.writeable
+
+    # Different methods are cached separately
+    cache.get(grids[1], 'tridiagonal')
+    assert cache.info().keys == [(10, 24, 'dense'), (12, 20, 'tridiagonal')]
+
+    cache.clear()
+    assert cache.info().currsize == 0
+    assert cache.info().nbytes == 0
+
+
+def test_max_bytes(grids):
+    nbytes = [sum(arr.nbytes for arr in EigenbasisCache(maxsize=0).get(grid)) for grid in grids]
+    cache = EigenbasisCache(max_bytes=nbytes[0] + nbytes[1])
+    cache.warm(*grids)
+    assert cache.info().keys == [(10, 24, 'dense')]
+    assert cache.info().max_bytes == nbytes[0] + nbytes[1]
+
+    cache.warm(grids[0], grids[1])
+    assert cache.info().keys == [(10, 20, 'dense'), (12, 20, 'dense')]
+    assert cache.info().nbytes == nbytes[0] + nbytes[1]
+
+    # Lowering the limit evicts the least recently used eigenbases
+    cache.max_bytes = nbytes[1]
+    assert cache.info().keys == [(12, 20, 'dense')]
+
+    # Eigenbases larger than the limit are not held at all
+    cache.max_bytes = 0
+    assert cache.info().currsize == 0
+    cache.get(grids[0])
+    assert cache.info().currsize == 0
+
+    cache.max_bytes = None
+    cache.warm(*grids)
+    assert cache.info().currsize == 3
+
+
+def test_use_eigenbasis_cache(dipole_map):
+    override = EigenbasisCache()
+    with _use_eigenbasis_cache(override):
+        assert _current_eigenbasis_cache() is override
+        # Other threads still use the module-level cache
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            assert executor.submit(_current_eigenbasis_cache).result() is eigenbasis_cache
+        sunkit_magex.pfss.pfss(sunkit_magex.pfss.Input(dipole_map, 5, 2.5))
+    assert _current_eigenbasis_cache() is eigenbasis_cache
+    assert override.info().misses == 1
+
+
+def test_disk(grids, tmp_path):
+    cache = EigenbasisCache(maxsize=0, directory=tmp_path)
+    lam, Q = cache.get(grids[0])
+    # lam and Q are saved in the same file
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+    assert cache.info().currsize == 0
+
+    # A new cache (e.g. in a new process) loads from disk
+    new_cache = EigenbasisCache(directory=tmp_path)
+    disk_lam, disk_Q = new_cache.get(grids[0])
+    assert isinstance(disk_Q, np.memmap)
+    np.testing.assert_equal(disk_lam, lam)
+    np.testing.assert_equal(disk_Q, Q)
+
+    assert disk_Q.flags.c_contiguous
+
+    new_cache.clear(disk=True)
+    assert len(list(tmp_path.glob('*.npy'))) == 0
+
+
+def test_disk_invalid(grids, tmp_path):
+    cache = EigenbasisCache(maxsize=0, directory=tmp_path)
+    lam, Q = cache.get(grids[0])
+    path, = tmp_path.glob('*.npy')
+
+    # Files that are truncated, or don't have the expected layout, are
+    # treated as a miss and overwritten
+    data = np.load(path)
+    for bad in [data[:-1], data.reshape(1, -1), np.array([], dtype=float)]:
+        np.save(path, bad)
+        new_cache = EigenbasisCache(directory=tmp_path)
+        new_lam, new_Q = new_cache.get(grids[0])
+        np.testing.assert_equal(new_Q, Q)
+        assert new_cache.info().misses == 1
+        np.testing.assert_equal(np.load(path), data)
+    path.write_bytes(b'not an array')
+    np.testing.assert_equal(EigenbasisCache(directory=tmp_path).get(grids[0])[1], Q)
+
+
+def test_threads(grids, monkeypatch):
+    cache = EigenbasisCache()
+    # Eigenbases for different grids are computed at the same time, so this
+    # would time out if they were computed one after the other
+    barrier = threading.Barrier(2, timeout=10)
+    calls = []
+
+    def eigenbasis(grid, *args, **kwargs):
+        calls.append((grid.ns, grid.nphi))
+        barrier.wait()
+        return _eigenbasis(grid, *args, **kwargs)
+
+    # (sunkit_magex.pfss.pfss is the function rather than the module)
+    monkeypatch.setattr(sys.modules['sunkit_magex.pfss.pfss'], '_eigenbasis', eigenbasis)
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(cache.get, [grids[0], grids[1], grids[0], grids[1]]))
+    # Each eigenbasis is only computed once
+    assert sorted(calls) == [(10, 20), (12, 20)]
+    assert np.shares_memory(results[0][1], results[2][1])
+    assert cache.info().misses == 2
+    assert cache.info().hits == 2
+
+
+def test_truncated(grids):
+    cache = EigenbasisCache()
+    lam, Q = cache.get(grids[0], 'tridiagonal', m_max=2, n_modes=4)
+    assert lam.shape == (3, 4)
+    assert Q.shape == (3, 10, 4)
+    expected_lam, expected_Q = _eigenbasis(grids[0], 'tridiagonal')
+    np.testing.assert_allclose(lam, expected_lam[:3, :4], rtol=0, atol=1e-12)
+
+    # Asking for fewer modes reuses the entry
+    lam, Q = cache.get(grids[0], 'tridiagonal', m_max=1, n_modes=4)
+    assert lam.shape == (2, 4)
+    assert cache.info().hits == 1
+
+    # Asking for more modes replaces the entry
+    lam, Q = cache.get(grids[0], 'tridiagonal')
+    assert Q.shape == expected_Q.shape
+    assert cache.info().misses == 2
+    assert cache.info().currsize == 1
+
+
+def test_field_cache():
+    cache = FieldCache(max_bytes=250)
+    computed = []
+
+    def compute(n):
+        def f():
+            computed.append(n)
+            return np.zeros(n, dtype=np.uint8)
+        return f
+
+    a = cache.get('a', compute(100))
+    assert cache.get('a', compute(100)) is a
+    cache.get('b', compute(100))
+    assert computed == [100, 100]
+    assert cache.info().keys == ['a', 'b']
+    assert cache.info().nbytes == 200
+
+    # Using 'a' makes 'b' the least recently used, so it is evicted first
+    cache.get('a', compute(100))
+    cache.get('c', compute(100))
+    info = cache.info()
+    assert info.keys == ['a', 'c']
+    assert (info.hits, info.misses) == (2, 3)
+
+    # Too large to be stored
+    cache.get('d', compute(300))
+    assert cache.info().keys == ['a', 'c']
+
+    # Reducing the budget evicts straight away
+    cache.max_bytes = 100
+    assert cache.info().keys == ['c']
+
+    # Storing a field that was computed elsewhere replaces the old value
+    value = np.ones(100, dtype=np.uint8)
+    cache.set('c', value)
+    assert cache.get('c', compute(100)) is value
+    assert cache.info().nbytes == 100
+
+    cache.clear()
+    assert cache.info().keys == []
+    assert cache.info().nbytes == 0
+
+
+def test_field_cache_nbytes():
+    class Holder:
+        def __init__(self):
+            self.values = np.zeros(10)
+            self.grid = (np.zeros(2), np.zeros(3))
+            self.name = 'holder'
+
+    cache = FieldCache()
+    cache.get('holder', Holder)
+    cache.get('tuple', lambda: (np.zeros(4), np.zeros(5, dtype=np.float32)))
+    assert cache.info().nbytes == 8 * 15 + 8 * 4 + 4 * 5
+
+
+def test_field_cache_threads():
+    cache = FieldCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return np.zeros(10)
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda _: cache.get('a', compute), range(8)))
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_field_cache_threads_other_keys():
+    cache = FieldCache()
+    cached = cache.get('cached', lambda: np.zeros(10))
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        assert release.wait(10)
+        return np.ones(10)
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        future = executor.submit(cache.get, 'slow', slow)
+        assert started.wait(10)
+        # Other fields can be got, and computed, while 'slow' is computed
+        assert cache.get('cached', lambda: None) is cached
+        cache.get('other', lambda: np.zeros(5))
+        release.set()
+        np.testing.assert_equal(future.result(), 1)
+    assert cache.info().keys == ['cached', 'other', 'slow']
+
+
+def test_field_cache_compute_error():
+    cache = FieldCache()
+
+    def fail():
+        raise RuntimeError('failed')
+
+    with pytest.raises(RuntimeError, match='failed'):
+        cache.get('a', fail)
+    # A failed computation isn't stored, and can be retried
+    assert cache.info().keys == []
+    np.testing.assert_equal(cache.get('a', lambda: np.ones(2)), 1)
+
+
+def test_field_cache_pickle():
+    cache = FieldCache(max_bytes=1000)
+    cache.get('a', lambda: np.zeros(10))
+    cache = pickle.loads(pickle.dumps(cache))
+    assert cache.max_bytes == 1000
+    assert cache.info().keys == []
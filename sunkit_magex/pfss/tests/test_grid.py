@@ -0,0 +1,59 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from astropy.time import Time
+
+from sunpy.map import Map
+
+import sunkit_magex.pfss
+from sunkit_magex.pfss.grid import Grid
+
+
+@pytest.mark.parametrize('method', ['dense', 'tridiagonal'])
+@pytest.mark.parametrize(('ns', 'nphi', 'nr'), [(45, 90, 15), (60, 120, 20)])
+def test_estimate_resources(method, ns, nphi, nr):
+    header = sunkit_magex.pfss.utils.carr_cea_wcs_header(Time('1992-12-21'), (nphi, ns))
+    br = np.random.default_rng(0).normal(size=(ns, nphi))
+    input = sunkit_magex.pfss.Input(Map(br, header), nr, 2.5)
+    estimate = input.grid.estimate_resources(method=method)
+    assert set(estimate) == {'pfss', 'bg', 'brgi', 'trace'}
+
+    # Run once first so that any numba compilation isn't measured
+    sunkit_magex.pfss.pfss(input, method=method)
+    sunkit_magex.pfss.cache.eigenbasis_cache.clear()
+    tracemalloc.start()
+    try:
+        output = sunkit_magex.pfss.pfss(input, method=method)
+        pfss_memory = tracemalloc.get_traced_memory()[1]
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        output.bg
+        bg_memory = tracemalloc.get_traced_memory()[1] - start_memory
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        output._brgi
+        brgi_memory = tracemalloc.get_traced_memory()[1] - start_memory
+    finally:
+        tracemalloc.stop()
+    # The accuracy given in the docstring of estimate_resources
+    assert estimate['pfss'].memory == pytest.approx(pfss_memory, rel=0.2)
+    assert estimate['bg'].memory == pytest.approx(bg_memory, rel=0.2)
+    assert estimate['brgi'].memory == pytest.approx(brgi_memory, rel=0.2)
+
+
+def test_estimate_resources_options():
+    grid = Grid(180, 360, 50, 2.5)
+    with pytest.raises(ValueError, match='method must be one of'):
+        grid.estimate_resources(method='Dense')
+    estimate = grid.estimate_resources()
+    # Computing a few shells at a time uses less memory
+    assert grid.estimate_resources(shell_block=5)['pfss'].memory < estimate['pfss'].memory
+    # Truncating the modes is cheaper
+    truncated = grid.estimate_resources(method='tridiagonal', m_max=30, n_modes=30)
+    assert truncated['pfss'].flops < estimate['pfss'].flops
+    assert truncated['pfss'].memory < estimate['pfss'].memory
+    # Tracing costs more with more seeds
+    assert grid.estimate_resources(n_seeds=1000)['trace'].flops > estimate['trace'].flops
+    assert all(isinstance(value, (int, np.integer)) for stage in estimate.values() for value in stage)
@@ -0,0 +1,76 @@
+import concurrent.futures
+
+import numpy as np
+import pytest
+
+import sunkit_magex.pfss
+from sunkit_magex.pfss import instrumentation
+
+
+@pytest.fixture
+def dipole_input(dipole_map):
+    return sunkit_magex.pfss.Input(dipole_map, 10, 2.5)
+
+
+def test_disabled(dipole_input):
+    assert not instrumentation.is_enabled()
+    output = sunkit_magex.pfss.pfss(dipole_input)
+    output.bg
+    assert output.report.records == []
+
+
+def test_report(dipole_input):
+    sunkit_magex.pfss.cache.eigenbasis_cache.clear()
+    hooked = []
+    with instrumentation.instrument(hook=hooked.append):
+        assert instrumentation.is_enabled()
+        output = sunkit_magex.pfss.pfss(dipole_input, shell_block=4)
+        output.bg
+        output.bc
+        output._brgi
+    assert not instrumentation.is_enabled()
+
+    stages = [record.stage for record in output.report.records]
+    assert stages[:3] == ['eigensolve', 'fft', 'projection']
+    # One record for each block of shells
+    assert stages.count('radial_terms') == 3
+    assert stages.count('als_alp') == 3
+    totals = output.report.totals()
+    assert list(totals) == ['eigensolve', 'fft', 'projection', 'radial_terms',
+                            'inverse_fft', 'als_alp', 'bg', 'common_b', 'brgi']
+    assert totals['radial_terms'].wall_time == pytest.approx(
+        sum(r.wall_time for r in output.report.records if r.stage == 'radial_terms'))
+    # bg is computed in blocks, without computing common_b
+    assert totals['bg'].peak_memory > 0
+    assert totals['common_b'].peak_memory > 0
+    assert all(record.wall_time >= 0 for record in output.report.records)
+    assert hooked == output.report.records
+    assert 'common_b' in str(output.report)
+
+    # Cached stages aren't recorded again
+    with instrumentation.instrument(trace_memory=False):
+        output.bg
+        output = sunkit_magex.pfss.pfss(dipole_input)
+    assert 'eigensolve' not in output.report.totals()
+    assert all(record.peak_memory == 0 for record in output.report.records)
+
+
+def test_threads(dipole_input):
+    # Memory is only recorded in the thread that enabled instrumentation
+    with instrumentation.instrument():
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            output = executor.submit(sunkit_magex.pfss.pfss, dipole_input).result()
+        output.bg
+    totals = output.report.totals()
+    assert totals['fft'].peak_memory == 0
+    assert totals['fft'].wall_time > 0
+    assert totals['bg'].peak_memory > 0
+
+
+def test_batch_reports(dipole_map, dipole_input):
+    with instrumentation.instrument(trace_memory=False):
+        outputs = sunkit_magex.pfss.pfss_batch([dipole_input, dipole_input])
+    for output in outputs:
+        assert [record.stage for record in output.report.records].count('als_alp') == 1
+    # Stages shared by the inputs are in both reports
+    np.testing.assert_equal(outputs[0].report.records[0], outputs[1].report.records[0])
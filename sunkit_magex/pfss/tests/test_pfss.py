@@ -1,4 +1,9 @@
+import gc
+import importlib
 import pathlib
+import subprocess
+import sys
+import weakref
 from datetime import timedelta
 
 import numpy as np
@@ -16,6 +21,7 @@ from sunpy.coordinates import frames
 import sunkit_magex.pfss
 import sunkit_magex.pfss.coords
 from sunkit_magex.pfss import tracing
+from sunkit_magex.pfss.pfss import _als_alp, _eigenbasis
 
 R_sun = const.R_sun
 test_data = pathlib.Path(__file__).parent / 'data'
@@ -213,6 +219,58 @@ def test_shape(zero_map):
     assert (bg[0, ...] == bg[-1, ...]).all()
 
 
+def test_unitless_accessors(dipole_result):
+    input, out = dipole_result
+    for b, b_value in zip(out.bc, out.bc_value):
+        assert isinstance(b_value, np.ndarray)
+        assert not isinstance(b_value, u.Quantity)
+        np.testing.assert_array_equal(b.to_value(out.bunit), b_value)
+
+    bg_value = out.bg_value
+    assert not isinstance(bg_value, u.Quantity)
+    assert not bg_value.flags.writeable
+    assert out.bg_value is bg_value
+    # bg is a view of bg_value, not a copy
+    bg = out.bg
+    assert np.shares_memory(bg, bg_value)
+    assert bg.unit == out.bunit
+    with pytest.raises(ValueError, match='read-only'):
+        bg[0, 0, 0, 0] = 0 * out.bunit
+
+
+def test_field_cache(dipole_map):
+    input = sunkit_magex.pfss.Input(dipole_map, 10, 2.5)
+    out1 = sunkit_magex.pfss.pfss(input)
+    out2 = sunkit_magex.pfss.pfss(input)
+
+    # Each output has its own cache, so using them alternately does not
+    # recompute the fields
+    bg1, bg2 = out1.bg_value, out2.bg_value
+    assert out1.bg_value is bg1
+    assert out2.bg_value is bg2
+    assert out1.field_cache.info().keys == ['bg']
+    assert out1.field_cache.info().hits == 1
+
+    # The cache does not keep the output alive
+    ref = weakref.ref(out2)
+    del out2
+    gc.collect()
+    assert ref() is None
+
+    out1.clear_cache()
+    assert out1.field_cache.info().keys == []
+    np.testing.assert_array_equal(out1.bg_value, bg1)
+    assert out1.bg_value is not bg1
+
+    # With a budget smaller than all the fields, only the most recent are kept
+    out1.clear_cache()
+    out1.field_cache.max_bytes = bg1.nbytes
+    out1.bg_value
+    assert out1.field_cache.info().keys == ['bg']
+    out1._brgi
+    assert 'bg' not in out1.field_cache.info().keys
+
+
 def test_wrong_projection_error(dipole_map):
     dipole_map.meta['ctype1'] = 'HGLN-CAR'
     with pytest.raises(ValueError, match='must be CEA'):
@@ -281,3 +339,353 @@ def test_bvec_interpolator(dipole_result):
     match = "The obstime of one of more input coordinates do not match the pfss model obstime."
     with pytest.warns(UserWarning, match=match):
         out.get_bvec(wrong_datetime)
+
+
+def test_pfss_batch(dipole_map, dipole_result_closed):
+    input_closed, out_closed = dipole_result_closed
+    inputs = [sunkit_magex.pfss.Input(dipole_map, 10, 2.5),
+              input_closed,
+              sunkit_magex.pfss.Input(dipole_map, 5, 2)]
+    outputs = sunkit_magex.pfss.pfss_batch(inputs)
+    assert len(outputs) == len(inputs)
+    for input, out in zip(inputs, outputs):
+        expected = sunkit_magex.pfss.pfss(input)
+        assert out.grid is input.grid
+        for comp, expected_comp in zip(out._al, expected._al):
+            np.testing.assert_allclose(comp, expected_comp, atol=1e-12)
+
+    np.testing.assert_allclose(outputs[1].bc[0], out_closed.bc[0], atol=1e-12)
+
+
+def test_pfss_batch_different_grid(dipole_map, zero_map):
+    zero_input, _ = zero_map
+    dipole_map = dipole_map.resample([10, 10] * u.pix)
+    inputs = [zero_input, sunkit_magex.pfss.Input(dipole_map, 10, 2.5)]
+    with pytest.raises(ValueError, match='must have the same number of grid points'):
+        sunkit_magex.pfss.pfss_batch(inputs)
+
+
+@pytest.mark.parametrize('nphi', [20, 21])
+def test_tridiagonal_eigenbasis(nphi):
+    grid = sunkit_magex.pfss.grid.Grid(30, nphi, 10, 2.5)
+    lam_dense, Q_dense = _eigenbasis(grid, 'dense')
+    lam_tri, Q_tri = _eigenbasis(grid, 'tridiagonal')
+    np.testing.assert_allclose(lam_tri, lam_dense, rtol=0, atol=1e-12 * np.max(lam_dense))
+    # Eigenvectors are only defined up to a sign
+    signs = np.sign(np.sum(Q_dense * Q_tri, axis=1, keepdims=True))
+    np.testing.assert_allclose(Q_tri * signs, Q_dense, rtol=0, atol=1e-12)
+
+    with pytest.raises(ValueError, match='method must be one of'):
+        _eigenbasis(grid, 'not_a_method')
+
+
+def test_tridiagonal_method(dipole_result, dipole_result_closed):
+    for input, out in [dipole_result, dipole_result_closed]:
+        out_tri = sunkit_magex.pfss.pfss(input, method='tridiagonal')
+        for comp, expected_comp in zip(out_tri._al, out._al):
+            np.testing.assert_allclose(comp, expected_comp, rtol=0, atol=1e-12 * np.max(np.abs(expected_comp)))
+
+
+def test_eigenbasis_blocks(monkeypatch):
+    # Check that splitting the batched eigensolve into blocks of modes
+    # doesn't change the result
+    grid = sunkit_magex.pfss.grid.Grid(30, 20, 10, 2.5)
+    lam, Q = _eigenbasis(grid)
+    monkeypatch.setattr(importlib.import_module('sunkit_magex.pfss.pfss'), '_EIGH_BLOCK_BYTES', 3 * 8 * 30**2)
+    lam_blocks, Q_blocks = _eigenbasis(grid)
+    np.testing.assert_equal(lam_blocks, lam)
+    np.testing.assert_equal(Q_blocks, Q)
+
+
+@pytest.mark.parametrize('method', ['dense', 'tridiagonal'])
+def test_n_workers(monkeypatch, dipole_result, method):
+    input, _ = dipole_result
+    monkeypatch.setattr(importlib.import_module('sunkit_magex.pfss.pfss'), '_EIGH_BLOCK_BYTES', 3 * 8 * 30**2)
+    lam, Q = _eigenbasis(input.grid, method)
+    lam_threaded, Q_threaded = _eigenbasis(input.grid, method, n_workers=4)
+    np.testing.assert_equal(lam_threaded, lam)
+    np.testing.assert_equal(Q_threaded, Q)
+
+    out = sunkit_magex.pfss.pfss(input, method=method)
+    out_threaded = sunkit_magex.pfss.pfss(input, method=method, n_workers=4)
+    for comp, expected_comp in zip(out_threaded._al, out._al):
+        np.testing.assert_equal(comp, expected_comp)
+
+    with pytest.raises(ValueError, match='n_workers must be at least 1'):
+        sunkit_magex.pfss.pfss(input, n_workers=0)
+
+
+@pytest.mark.parametrize('shell_block', [1, 3, 100])
+def test_shell_block(dipole_result, dipole_result_closed, shell_block):
+    for input, out in [dipole_result, dipole_result_closed]:
+        out_block = sunkit_magex.pfss.pfss(input, shell_block=shell_block)
+        for comp, expected_comp in zip(out_block._al, out._al):
+            np.testing.assert_allclose(comp, expected_comp, rtol=0, atol=1e-12 * np.max(np.abs(expected_comp)))
+
+
+def test_memmap_out(dipole_result, tmp_path):
+    input, out = dipole_result
+    nr, ns, nphi = input.grid.nr, input.grid.ns, input.grid.nphi
+    als = np.lib.format.open_memmap(tmp_path / 'als.npy', mode='w+', shape=(nphi + 1, ns, nr + 1))
+    alp = np.lib.format.open_memmap(tmp_path / 'alp.npy', mode='w+', shape=(nphi, ns + 1, nr + 1))
+    out_mmap = sunkit_magex.pfss.pfss(input, shell_block=2, out=(als, alp))
+    assert out_mmap._als is als
+    assert out_mmap._alp is alp
+    for comp, expected_comp in zip(out_mmap._al, out._al):
+        np.testing.assert_allclose(comp, expected_comp, rtol=0, atol=1e-12 * np.max(np.abs(expected_comp)))
+    np.testing.assert_allclose(out_mmap.bc[0], out.bc[0], rtol=0, atol=1e-12)
+
+    with pytest.raises(ValueError, match='out arrays must have shapes'):
+        sunkit_magex.pfss.pfss(input, out=(alp, als))
+    with pytest.raises(ValueError, match='shell_block must be at least 1'):
+        sunkit_magex.pfss.pfss(input, shell_block=0)
+
+
+@pytest.mark.parametrize(('n_workers', 'phi_block'), [(1, 1), (1, None), (3, 4), (2, 1000)])
+def test_compute_bg(dipole_result, n_workers, phi_block):
+    input, out = dipole_result
+    # The field on the cell faces averaged over the whole grid at once
+    br, bs, bp, Sbr, Sbs, Sbp = out._calculate_common_b()
+    expected = np.empty(out.bg_value.shape)
+    sunkit_magex.pfss.output._average_to_grid(br, bs, bp, Sbr, Sbs, Sbp, expected)
+
+    output = sunkit_magex.pfss.pfss(input)
+    bg = output.compute_bg(n_workers=n_workers, phi_block=phi_block)
+    np.testing.assert_array_equal(bg, expected)
+    assert not bg.flags.writeable
+    assert output.bg_value is bg
+    assert output.field_cache.info().keys == ['bg']
+
+
+def test_compute_bg_memmap(dipole_result, tmp_path):
+    input, out = dipole_result
+    output = sunkit_magex.pfss.pfss(input)
+    bg = np.lib.format.open_memmap(tmp_path / 'bg.npy', mode='w+', shape=out.bg_value.shape)
+    result = output.compute_bg(n_workers=2, phi_block=5, out=bg)
+    assert np.shares_memory(result, bg)
+    assert bg.flags.writeable
+    np.testing.assert_array_equal(bg, out.bg_value)
+
+    with pytest.raises(ValueError, match='out must have shape'):
+        output.compute_bg(out=bg[1:])
+    with pytest.raises(ValueError, match='out must have dtype float64'):
+        output.compute_bg(out=bg.astype(np.float32))
+    with pytest.raises(ValueError, match='phi_block must be at least 1'):
+        output.compute_bg(phi_block=0)
+    with pytest.raises(ValueError, match='n_workers must be at least 1'):
+        output.compute_bg(n_workers=0)
+
+
+def test_float32(dipole_result, tmp_path):
+    input, out = dipole_result
+    out32 = sunkit_magex.pfss.pfss(input, dtype=np.float32, shell_block=3)
+    assert out.dtype == np.float64
+    assert out32.dtype == np.float32
+    assert all(al.dtype == np.float32 for al in out32._al)
+    assert out32.bg_value.dtype == np.float32
+    assert out32._modbg.dtype == np.float32
+    # The solution is computed in double precision and only rounded when stored
+    for b32, b64 in [(out32.bg_value, out.bg_value), *zip(out32.bc_value, out.bc_value)]:
+        assert b32.dtype == np.float32
+        np.testing.assert_allclose(b32, b64, rtol=0, atol=1e-6 * np.max(np.abs(b64)))
+    assert out32.bg.dtype == np.float32
+    assert out32.bc[0].dtype == np.float32
+
+    # The field is computed from the stored vector potential in double
+    # precision, and only rounded when stored
+    out_upcast = sunkit_magex.pfss.Output(*(al.astype(np.float64) for al in out32._al), out32.grid, out32.input_map)
+    for b32, b64 in zip(out32._common_b()[:3], out_upcast._common_b()[:3]):
+        assert b32.dtype == np.float32
+        np.testing.assert_array_equal(b32, b64.astype(np.float32))
+    np.testing.assert_array_equal(out32.bg_value, out_upcast.bg_value.astype(np.float32))
+
+    # The dtype of the out arrays is used
+    nr, ns, nphi = input.grid.nr, input.grid.ns, input.grid.nphi
+    als = np.lib.format.open_memmap(tmp_path / 'als.npy', mode='w+', shape=(nphi + 1, ns, nr + 1), dtype=np.float32)
+    alp = np.lib.format.open_memmap(tmp_path / 'alp.npy', mode='w+', shape=(nphi, ns + 1, nr + 1), dtype=np.float32)
+    out_mmap = sunkit_magex.pfss.pfss(input, out=(als, alp))
+    assert out_mmap.dtype == np.float32
+    np.testing.assert_array_equal(out_mmap.bg_value, out32.bg_value)
+
+    spectral = sunkit_magex.pfss.pfss(input, spectral=True)
+    assert spectral.to_output(dtype=np.float32).dtype == np.float32
+
+    with pytest.raises(ValueError, match='does not match the dtype of the out arrays'):
+        sunkit_magex.pfss.pfss(input, out=(als, alp), dtype=np.float64)
+    with pytest.raises(ValueError, match='out arrays must have the same dtype'):
+        sunkit_magex.pfss.pfss(input, out=(als, alp.astype(np.float64)))
+    with pytest.raises(ValueError, match='dtype must be float32 or float64'):
+        sunkit_magex.pfss.pfss(input, dtype=np.float16)
+    with pytest.raises(ValueError, match='dtype cannot be given if spectral=True'):
+        sunkit_magex.pfss.pfss(input, dtype=np.float32, spectral=True)
+
+
+def test_als_alp():
+    # Compare to a direct loop over the grid
+    nr, ns, nphi = 4, 6, 8
+    rng = np.random.default_rng(0)
+    psi = rng.random((nr + 1, ns, nphi))
+    Fs = rng.random(ns)
+    Fp = rng.random(ns + 1)
+
+    als = np.zeros((nphi + 1, ns, nr + 1))
+    alp = np.zeros((nphi, ns + 1, nr + 1))
+    _als_alp(Fs, psi, Fp, als, alp)
+
+    expected_als = np.zeros_like(als)
+    expected_alp = np.zeros_like(alp)
+    for j in range(nr + 1):
+        for i in range(nphi + 1):
+            expected_als[i, :, j] = Fs * (psi[j, :, ((i - 1) % nphi)] - psi[j, :, ((i) % nphi)])
+        for i in range(nphi):
+            expected_alp[i, 1:-1, j] = Fp[1:-1] * (psi[j, 1:, i] - psi[j, :-1, i])
+    np.testing.assert_equal(als, expected_als)
+    np.testing.assert_equal(alp, expected_alp)
+
+
+def test_spectral_output(dipole_result):
+    input, output = dipole_result
+    spectral = sunkit_magex.pfss.pfss(input, spectral=True)
+    assert isinstance(spectral, sunkit_magex.pfss.SpectralOutput)
+    br, bs, bp = output.bc
+    atol = 1e-12 * np.max(np.abs(br.value))
+
+    for k in [0, 4, input.grid.nr]:
+        spectral_br = spectral.bc(np.exp(input.grid.rg[k]))[0]
+        assert spectral_br.unit == br.unit
+        np.testing.assert_allclose(spectral_br.value, br[:, :, k].value, rtol=0, atol=atol)
+    for k in [0, 4, input.grid.nr - 1]:
+        _, spectral_bs, spectral_bp = spectral.bc(np.exp(input.grid.rc[k]))
+        np.testing.assert_allclose(spectral_bs.value, bs[:, :, k].value, rtol=0, atol=atol)
+        np.testing.assert_allclose(spectral_bp.value, bp[:, :, k].value, rtol=0, atol=atol)
+
+    np.testing.assert_allclose(spectral.source_surface_br.data,
+                               output.source_surface_br.data, rtol=0, atol=atol)
+    assert spectral.br_map(1.5).data.shape == output.source_surface_br.data.shape
+
+    np.testing.assert_allclose(spectral.to_output().bc[0].value, br.value, rtol=0, atol=atol)
+
+    with pytest.raises(ValueError, match='r must be between 1 and the source surface radius'):
+        spectral.bc(input.grid.rss + 0.1)
+    with pytest.raises(ValueError, match='out cannot be given if spectral=True'):
+        sunkit_magex.pfss.pfss(input, spectral=True, out=(None, None, None))
+
+
+def test_truncation(dipole_map, dipole_result):
+    input, output = dipole_result
+    assert (output.m_max, output.n_modes) == (input.grid.nphi // 2, input.grid.ns)
+
+    # Including every mode gives the full solution
+    full = sunkit_magex.pfss.pfss(input, m_max=1000, n_modes=1000)
+    assert (full.m_max, full.n_modes) == (output.m_max, output.n_modes)
+    np.testing.assert_equal(full.bc[0].value, output.bc[0].value)
+
+    # Truncating m low-pass filters the boundary condition in phi
+    m_max = 3
+    truncated = sunkit_magex.pfss.pfss(input, m_max=m_max)
+    assert (truncated.m_max, truncated.n_modes) == (m_max, input.grid.ns)
+    brt = np.fft.rfft(input.br, axis=1)
+    brt[:, m_max + 1:] = 0
+    expected = np.fft.irfft(brt, n=input.grid.nphi, axis=1)
+    # (the monopole is always excluded)
+    expected -= np.mean(expected)
+    np.testing.assert_allclose(truncated.bc[0][:, :, 0].value, expected.T,
+                               rtol=0, atol=1e-12 * np.max(np.abs(expected)))
+
+    # Only computing some of the eigenmodes gives the same solution as
+    # computing all of them and dropping the rest
+    n_modes = 5
+    dense = sunkit_magex.pfss.pfss(input, m_max=m_max, n_modes=n_modes)
+    tridiagonal = sunkit_magex.pfss.pfss(input, m_max=m_max, n_modes=n_modes, method='tridiagonal')
+    assert (tridiagonal.m_max, tridiagonal.n_modes) == (m_max, n_modes)
+    np.testing.assert_allclose(tridiagonal.bc[0].value, dense.bc[0].value,
+                               rtol=0, atol=1e-12 * np.max(np.abs(dense.bc[0].value)))
+
+    spectral = sunkit_magex.pfss.pfss(input, m_max=m_max, n_modes=n_modes, spectral=True)
+    assert (spectral.m_max, spectral.n_modes) == (m_max, n_modes)
+    assert (spectral.to_output().m_max, spectral.to_output().n_modes) == (m_max, n_modes)
+
+    with pytest.raises(ValueError, match='m_max must be at least 0'):
+        sunkit_magex.pfss.pfss(input, m_max=-1)
+    with pytest.raises(ValueError, match='n_modes must be at least 1'):
+        sunkit_magex.pfss.pfss(input, n_modes=0)
+
+
+def test_pfss_surface(dipole_result):
+    input, output = dipole_result
+    source_surface_br = output.source_surface_br
+    atol = 1e-12 * np.max(np.abs(source_surface_br.data))
+
+    ss_map, = sunkit_magex.pfss.pfss_surface(input)
+    np.testing.assert_allclose(ss_map.data, source_surface_br.data, rtol=0, atol=atol)
+    assert ss_map.plot_settings['cmap'] == source_surface_br.plot_settings['cmap']
+
+    radii = np.exp(input.grid.rg[[0, 3]])
+    maps = sunkit_magex.pfss.pfss_surface(input, radii)
+    assert len(maps) == 2
+    for m, k in zip(maps, [0, 3]):
+        np.testing.assert_allclose(m.data, output.bc[0][:, :, k].value.T, rtol=0, atol=atol)
+
+    with pytest.raises(ValueError, match='r must be between 1 and the source surface radius'):
+        sunkit_magex.pfss.pfss_surface(input, [0.5, 1])
+
+
+def test_pfss_rss_sweep(dipole_map):
+    nr = 10
+    rss_values = [1.5, 2.5, 3]
+    outputs = sunkit_magex.pfss.pfss_rss_sweep(sunkit_magex.pfss.Input(dipole_map, nr, 2.5), rss_values)
+    assert len(outputs) == len(rss_values)
+    for output, rss in zip(outputs, rss_values):
+        assert isinstance(output, sunkit_magex.pfss.SpectralOutput)
+        assert output.grid.rss == rss
+        expected = sunkit_magex.pfss.pfss(sunkit_magex.pfss.Input(dipole_map, nr, rss))
+        expected_br = expected.source_surface_br.data
+        np.testing.assert_allclose(output.source_surface_br.data, expected_br,
+                                   rtol=0, atol=1e-12 * np.max(np.abs(expected_br)))
+
+    with pytest.raises(ValueError, match='rss values must be greater than 1'):
+        sunkit_magex.pfss.pfss_rss_sweep(sunkit_magex.pfss.Input(dipole_map, nr, 2.5), [1])
+
+
+def test_pfss_outer_sweep(dipole_map):
+    nr = 10
+    rss = 2.5
+    input = sunkit_magex.pfss.Input(dipole_map, nr, rss)
+    br_outers = [sunpy.map.Map(dipole_map.data * scale, dipole_map.meta) for scale in [0.1, -0.2]]
+    outputs = sunkit_magex.pfss.pfss_outer_sweep(input, br_outers)
+    assert len(outputs) == len(br_outers)
+    for output, br_outer in zip(outputs, br_outers):
+        expected = sunkit_magex.pfss.pfss(sunkit_magex.pfss.Input(dipole_map, nr, rss, br_outer))
+        expected_br = expected.bc[0].value
+        atol = 1e-12 * np.max(np.abs(expected_br))
+        np.testing.assert_allclose(output.to_output().bc[0].value, expected_br, rtol=0, atol=atol)
+        np.testing.assert_allclose(output.source_surface_br.data, expected.source_surface_br.data,
+                                   rtol=0, atol=atol)
+
+    with pytest.raises(ValueError, match='br and br_outer must have the same dimensions'):
+        sunkit_magex.pfss.pfss_outer_sweep(input, [sunpy.map.Map(dipole_map.data[:, :-2], dipole_map.meta)])
+
+
+def test_warmup():
+    pfss_module = importlib.import_module('sunkit_magex.pfss.pfss')
+    assert sunkit_magex.pfss.warmup() == pfss_module.HAS_NUMBA
+    if pfss_module.HAS_NUMBA:
+        compiled = pfss_module._jit(pfss_module._compute_r_term)
+        assert len(compiled.signatures) == 2
+
+
+@pytest.mark.parametrize('module', ['numba', 'sympy', 'streamtracer', 'sunpy.map', 'astropy.coordinates'])
+def test_lazy_imports(module):
+    # Importing the package should not import slow to import packages
+    code = f'import sys, sunkit_magex.pfss; assert {module!r} not in sys.modules'
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+def test_lazy_attributes():
+    assert sunkit_magex.pfss.Output is importlib.import_module('sunkit_magex.pfss.output').Output
+    assert sunkit_magex.pfss.tracing is importlib.import_module('sunkit_magex.pfss.tracing')
+    assert sunkit_magex.pfss.accuracy is importlib.import_module('sunkit_magex.pfss.accuracy')
+    # The pfss function is not replaced by the submodule of the same name
+    assert callable(sunkit_magex.pfss.pfss)
+    with pytest.raises(AttributeError, match='has no attribute'):
+        sunkit_magex.pfss.not_an_attribute
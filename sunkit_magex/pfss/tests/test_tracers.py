@@ -54,6 +54,8 @@ def test_fline_step_size(dipole_result):
     assert out.grid.nr == 10
     # With a step size of 0.2, this should be ~50
     assert len(flines[0]) == 52
+    # The vector grid is only created once for the output
+    assert out.field_cache.info().keys.count(('vector_grid', tracing.PerformanceTracer)) == 1
 
 
 def test_rot_warning(dipole_result):
@@ -65,3 +67,15 @@ def test_rot_warning(dipole_result):
 
     with pytest.warns(UserWarning, match='ran out of steps'):
         tracer.trace(seed, out)
+
+
+@pytest.mark.parametrize('tracer', [tracing.PythonTracer(), tracing.PerformanceTracer()],
+                         ids=['python', 'compiled'])
+def test_float32_output(dipole_result, tracer):
+    input, out = dipole_result
+    out32 = sunkit_magex.pfss.pfss(input, dtype=np.float32)
+    seed = coord.SkyCoord(2*u.deg, -45*u.deg, 1.01*const.R_sun, frame=out.coordinate_frame)
+    expected = tracer.trace(seed, out)[0].coords.cartesian.xyz
+    fline = tracer.trace(seed, out32)[0].coords.cartesian.xyz
+    assert fline.shape == expected.shape
+    assert u.allclose(fline, expected, rtol=0, atol=1e-4 * const.R_sun)
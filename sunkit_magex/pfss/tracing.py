@@ -116,7 +116,8 @@ class PerformanceTracer(Tracer):
         Create a `streamtracer.VectorGrid` object from an `~sunkit_magex.pfss.Output`.
         """
         # The indexing order on the last index is (phi, s, r)
-        vectors = output.bg.copy()
+        # (streamtracer only supports double precision fields)
+        vectors = output.bg_value.astype(np.float64)
 
         # Correct s direction for coordinate system distortion
         sqrtsg = output.grid._sqrtsg_correction
@@ -157,7 +158,9 @@ class PerformanceTracer(Tracer):
         seeds = np.atleast_2d(np.stack((phi, s, rho), axis=-1))
 
         # Get a grid
-        vector_grid = self.vector_grid(output)
+        # (cached by the output, since it only depends on the output)
+        vector_grid = output.field_cache.get(('vector_grid', type(self)),
+                                             lambda: self.vector_grid(output))
 
         # Do the tracing
         #